@@ -0,0 +1,101 @@
+####
+# stratified quasi-monte carlo sampling, every FEES x HOURS cell draws its own low-discrepancy sequence over the other
+# params and stops once the confidence intervals of its key metrics reach the target precision
+####
+
+import warnings
+
+import numpy as np
+import pandas as pd
+from numpy.random import SeedSequence, default_rng
+from scipy.stats import norm
+
+from simulation_parameters import FEES, HOURS, SAMPLED_PARAMS, create_qmc_sampler, sample_qmc_params_batch
+from results_store import create_moments, update_moments
+
+CONVERGENCE_METRICS = ['total_profit', 'percent_self_closed']
+CONFIDENCE = .95
+RELATIVE_PRECISION = .05  # a cell stops once every metric's CI half width is within 5% of its mean
+MIN_SIMS_PER_CELL = 128  # fewer runs give too noisy a variance estimate to stop on
+
+
+####
+# cells
+####
+
+def create_cells(method='sobol', seed=None, sampled_params=SAMPLED_PARAMS):
+    """ one cell per upfront_fee x upfront_hours pair, each with an independently scrambled sampler
+        the samplers only span sampled_params, so params the simulation sets itself don't waste dimensions """
+    pairs = [(fee, hours) for fee in FEES for hours in HOURS]
+    seeds = SeedSequence(seed).spawn(len(pairs))
+
+    return [{'upfront_fee': float(fee), 'upfront_hours': float(hours), 'n_sampled': 0, 'n_sims': 0,
+             'converged': False, 'sampled_params': list(sampled_params),
+             'sampler': create_qmc_sampler(method, default_rng(cell_seed), len(sampled_params)),
+             'moments': {metric: create_moments() for metric in CONVERGENCE_METRICS}}
+            for (fee, hours), cell_seed in zip(pairs, seeds)]
+
+
+def sample_cell(cell, n):
+    """ draws the cell's next n param sets as a structured array """
+    cell['n_sampled'] += n
+    with warnings.catch_warnings():  # a cell's last round is cut to its budget, so sobol draws can be unbalanced
+        warnings.filterwarnings('ignore', 'The balance properties of Sobol', UserWarning)
+        return sample_qmc_params_batch(cell['sampler'], n, cell['upfront_fee'], cell['upfront_hours'],
+                                       cell['sampled_params'])
+
+
+def update_cell(cell, result_df):
+    """ folds a chunk of the cell's results into its running moments """
+    cell['n_sims'] += result_df.shape[0]
+    for metric in CONVERGENCE_METRICS:
+        update_moments(cell['moments'][metric], np.asarray(result_df[metric], dtype=float))
+
+
+####
+# convergence
+####
+
+def get_ci_half_width(moments, confidence=CONFIDENCE):
+    """ normal approximation CI half width of the mean, treating the points as independent
+        this is conservative for scrambled sobol and latin hypercube points, whose means vary less than iid means """
+    if moments['count'] < 2:
+        return np.inf
+
+    return norm.ppf(.5 + confidence / 2) * np.sqrt(moments['m2'] / (moments['count'] - 1) / moments['count'])
+
+
+def is_cell_converged(cell, relative_precision=RELATIVE_PRECISION, absolute_precision=0, confidence=CONFIDENCE,
+                      min_sims=MIN_SIMS_PER_CELL):
+    """ true once every metric's CI half width is within relative_precision of |mean| or within absolute_precision
+        absolute_precision keeps metrics with means near 0 from running until max_sims_per_cell """
+    if cell['n_sims'] < min_sims:
+        return False
+
+    return all(get_ci_half_width(moments, confidence) <= max(relative_precision * abs(moments['mean']),
+                                                             absolute_precision)
+               for moments in cell['moments'].values())
+
+
+def get_active_cells(cells, max_sims_per_cell=None):
+    """ indices of cells that have neither converged nor used up their budget """
+    return [i for i, cell in enumerate(cells) if not cell['converged'] and
+            (max_sims_per_cell is None or cell['n_sampled'] < max_sims_per_cell)]
+
+
+def get_round_size(cell, round_size, max_sims_per_cell=None):
+    """ n points of the cell's next round, cut to what is left of its budget """
+    if max_sims_per_cell is None:
+        return round_size
+
+    return min(round_size, max_sims_per_cell - cell['n_sampled'])
+
+
+def summarize_cells(cells, confidence=CONFIDENCE):
+    """ returns n simulations, convergence and each metric's mean and CI half width per cell """
+    return pd.DataFrame([{'upfront_fee': cell['upfront_fee'], 'upfront_hours': cell['upfront_hours'],
+                          'n_sims': cell['n_sims'], 'converged': cell['converged'],
+                          **{key: value for metric, moments in cell['moments'].items() for key, value in
+                             ((metric + '_mean', moments['mean']),
+                              (metric + '_ci', get_ci_half_width(moments, confidence)))}}
+                         for cell in cells])
@@ -0,0 +1,243 @@
+#########
+# These functions run many parameter sets through the simulation in one vectorized pass
+# stream events are flat arrays tagged with the run they belong to, and per-minute data are only kept for the
+# minutes where a run has an event, since every cumulative series is flat in between
+#########
+
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng
+
+from simulation_functions import (LIQUIDATION_GAS, OPEN_GAS, gwei_to_eth, minute_to_month, month_to_minute,
+                                  stream_rate_to_margin, calculate_liquidation_probabilities,
+                                  identify_deliberate_liquidations, find_best_executions)
+from metrics_extraction import calculate_metrics_batch
+from instrumentation import instrument, add_counts
+
+rng = default_rng()
+
+BATCH_SIZE = 64  # runs per vectorized pass, each run holds a few arrays of its event minutes and 5 bytes per minute
+
+
+####
+# param helpers
+####
+
+def get_param_arrays(params_batch):
+    """ converts a structured array or a list of param dicts into a dict of 1-D float arrays, one value per run """
+    if isinstance(params_batch, np.ndarray) and params_batch.dtype.names:
+        return {p: params_batch[p].astype(float) for p in params_batch.dtype.names}
+
+    return {p: np.array([params[p] for params in params_batch], dtype=float) for p in params_batch[0]}
+
+
+def get_event_params(params, run_ids):
+    """ expands per-run params to one value per event so the single run functions broadcast over events """
+    return {p: params[p][run_ids] for p in params}
+
+
+####
+# batched stream & liquidation arrival time simulation functions
+####
+
+def sample_new_stream_times_batch(n_minutes, params):
+    """ sample_new_stream_times for every run, returns run ids and opening times """
+    n_months = minute_to_month(n_minutes)
+    expected_stream_openings = (params['monthly_opened_streams'] * n_months // 1).astype(int)
+    run_ids = np.repeat(np.arange(expected_stream_openings.shape[0]), expected_stream_openings)
+
+    return run_ids, rng.uniform(0, n_minutes, run_ids.shape[0]).astype(int)
+
+
+def sample_stream_sizes_batch(run_ids, stream_times, gas_price, eth_price, params):
+    """ sample_stream_sizes for every run, gathers gas and eth prices for all runs' openings at once """
+    event_params = get_event_params(params, run_ids)
+    gamma_k = event_params['distribution_inverse_skewness']
+    theta = event_params['average_stream_size'] / gamma_k
+    stream_costs = ((OPEN_GAS * gwei_to_eth(gas_price[stream_times]) + event_params['upfront_fee']) *
+                    eth_price[stream_times] * event_params['lowest_stream_cost_ratio'])
+
+    stream_sizes = rng.gamma(gamma_k, theta)
+    opened_streams_mask = np.asarray(stream_sizes > stream_costs)
+
+    return run_ids[opened_streams_mask], stream_times[opened_streams_mask], stream_sizes[opened_streams_mask]
+
+
+def simulate_naive_liquidation_times_batch(run_ids, times, sizes, n_minutes, params):
+    """ simulate_naive_liquidation_times for every run, returns (run ids, times, sizes) for liquidations and
+        self-closes """
+    prob_self_closed, prob_liquidated, prob_closing_tx_is_liquidation = calculate_liquidation_probabilities(
+        get_event_params(params, run_ids))
+
+    times = times + np.minimum(rng.exponential(1 / prob_liquidated), rng.exponential(1 / prob_self_closed))
+    valid_mask = np.asarray(times < n_minutes)
+    liquidation_mask = np.asarray(rng.uniform(0, 1, run_ids.shape[0]) < prob_closing_tx_is_liquidation)
+
+    liquidations = [x[liquidation_mask & valid_mask] for x in (run_ids, times.astype(int), sizes)]
+    self_closes = [x[~liquidation_mask & valid_mask] for x in (run_ids, times.astype(int), sizes)]
+
+    return liquidations, self_closes
+
+
+def convert_small_self_closes_to_liquidations_batch(liquidations, self_closes, gas_price, eth_price, params):
+    """ convert_small_self_closes_to_liquidations for every run """
+    run_ids, times, sizes = self_closes
+    deliberate_liquidations_mask = identify_deliberate_liquidations(gas_price, eth_price, times, sizes,
+                                                                    get_event_params(params, run_ids))
+
+    liquidations = [np.concatenate([x, y[deliberate_liquidations_mask]]) for x, y in zip(liquidations, self_closes)]
+    self_closes = [x[~deliberate_liquidations_mask] for x in self_closes]
+
+    return liquidations, self_closes
+
+
+@instrument('bin_times_and_sizes_batch')
+def bin_times_and_sizes_batch(run_ids, times, n_minutes, sizes):
+    """ bin_times_and_sizes for every run, returns sorted run * n_minutes + minute keys of the minutes with events,
+        their counts and the summed sizes of their streams
+        the keys are sparse over n_runs * n_minutes, so unlike bin_times_and_sizes they are found by sorting """
+    unique_values, inverse, counts = np.unique(run_ids * n_minutes + times, return_inverse=True, return_counts=True)
+    add_counts(n_events=times.shape[0], n_unique_minutes=unique_values.shape[0])
+
+    return unique_values, counts, np.bincount(inverse, weights=sizes, minlength=unique_values.shape[0])
+
+
+@instrument('simulate_streams_and_liquidations_batch')
+def simulate_streams_and_liquidations_batch(gas_price, eth_price, params):
+    """ simulates (run ids, times) of openings and self-closes and (run ids, times, sizes) of liquidations """
+    n_minutes = gas_price.shape[0]
+    run_ids, times = sample_new_stream_times_batch(n_minutes, params)
+    run_ids, times, sizes = sample_stream_sizes_batch(run_ids, times, gas_price, eth_price, params)
+
+    liquidations, self_closes = simulate_naive_liquidation_times_batch(run_ids, times, sizes, n_minutes, params)
+    liquidations, self_closes = convert_small_self_closes_to_liquidations_batch(liquidations, self_closes,
+                                                                                gas_price, eth_price, params)
+    add_counts(n_streams=times.shape[0], n_liquidations=liquidations[0].shape[0],
+               n_self_closes=self_closes[0].shape[0])
+
+    return (run_ids, times), liquidations, self_closes[:2]
+
+
+def remove_events_past_valid_minutes(events, n_valid):
+    """ drops events after the end of their run's valid data, like the df cut by the gas prediction window """
+    mask = np.asarray(events[1] < n_valid[events[0]])
+
+    return [x[mask] for x in events]
+
+
+####
+# batched profit & loss
+####
+
+def get_n_valid_minutes(n_minutes, params):
+    """ returns each run's n minutes with a full gas prediction window, n_minutes for runs without prediction """
+    window_sizes = (params['gas_prediction_ability'] * 60).astype(int) - 2
+
+    return np.where(params['gas_prediction_ability'] > 3 / 60, n_minutes - window_sizes + 1, n_minutes)
+
+
+@instrument('calculate_pl_batch')
+def calculate_pl_batch(keys, counts, sizes, gas_price, three_min_median, eth_price, params):
+    """ calculate_pl for every run's binned liquidation minutes and summed sizes, returns liquidator usd P&L and eth
+        refunded per minute
+        runs with gas prediction are resolved together by one find_best_executions call over all their liquidations """
+    n_minutes = gas_price.shape[0]
+    runs, times = keys // n_minutes, keys % n_minutes
+    refund_rate = params['refund_rate'][runs]
+    posted_margin = stream_rate_to_margin(sizes, params['upfront_hours'][runs])
+    liquidation_gas_eth = LIQUIDATION_GAS * counts * gwei_to_eth(gas_price[times])
+
+    liquidator_pl = posted_margin - liquidation_gas_eth * eth_price[times] * (1 - refund_rate)
+    gas_refunded_eth = liquidation_gas_eth * refund_rate
+
+    prediction_mask = np.asarray(params['gas_prediction_ability'][runs] > 3 / 60)
+    if np.any(prediction_mask):
+        runs, times = runs[prediction_mask], times[prediction_mask]
+        window_sizes = (params['gas_prediction_ability'][runs] * 60).astype(int) - 2
+        gas_prices_paid, liquidator_pl[prediction_mask] = find_best_executions(
+            three_min_median, times, posted_margin[prediction_mask], month_to_minute(sizes[prediction_mask]),
+            eth_price[times], window_sizes, refund_rate[prediction_mask], tx_counts=counts[prediction_mask])
+        gas_refunded_eth[prediction_mask] = (LIQUIDATION_GAS * counts[prediction_mask] * gwei_to_eth(gas_prices_paid) *
+                                             refund_rate[prediction_mask])
+
+    return liquidator_pl, gas_refunded_eth
+
+
+####
+# aggregate functions
+####
+
+def get_event_minute_columns(n_runs, n_minutes, event_keys):
+    """ lays out every run's minutes with events, plus its first minute, as the columns of a (n_runs x max n event
+        minutes) array, returns the run and column of each of those minutes and a key -> minute index lookup
+        the first minute is always kept so cumsums start where calculate_metrics starts them """
+    has_event = np.zeros(n_runs * n_minutes, dtype=bool)  # one byte per run minute, no sorting needed
+    has_event[::n_minutes] = True
+    for keys in event_keys:
+        has_event[keys] = True
+
+    minute_lookup = np.cumsum(has_event, dtype=np.int32) - 1
+    runs = np.flatnonzero(has_event) // n_minutes
+    columns = np.arange(runs.shape[0]) - minute_lookup[runs * n_minutes]
+
+    return runs, columns, minute_lookup
+
+
+def scatter_to_event_minutes(runs, columns, minute_lookup, event_keys, weights=None):
+    """ sums per-event values into the (n_runs x max n event minutes) array laid out by get_event_minute_columns
+        columns past a run's last event minute stay 0 so its cumsums stay flat """
+    n_runs, n_columns = runs[-1] + 1, np.max(columns) + 1
+    event_minutes = minute_lookup[event_keys]
+    flat_slots = runs[event_minutes] * n_columns + columns[event_minutes]
+
+    return np.bincount(flat_slots, weights=weights, minlength=n_runs * n_columns).reshape(n_runs, n_columns)
+
+
+@instrument('simulate_and_calculate_metrics_batch')
+def simulate_and_calculate_metrics_batch(prices, params):
+    """ simulates every run in one vectorized pass and returns a dict of metric arrays with the calculate_metrics keys
+        prices is a df or dict with median_gas_price, three_min_median and price columns """
+    gas_price = np.asarray(prices['median_gas_price'], dtype=float)
+    three_min_median = np.asarray(prices['three_min_median'], dtype=float)
+    eth_price = np.asarray(prices['price'], dtype=float)
+    n_runs, n_minutes = params['upfront_fee'].shape[0], eth_price.shape[0]
+    n_valid = get_n_valid_minutes(n_minutes, params)
+    add_counts(n_runs=n_runs, n_elements=n_minutes)
+
+    openings, liquidations, self_closes = [remove_events_past_valid_minutes(events, n_valid) for events in
+                                           simulate_streams_and_liquidations_batch(gas_price, eth_price, params)]
+    liquidation_keys, liquidation_counts, liquidation_sizes = bin_times_and_sizes_batch(*liquidations[:2], n_minutes,
+                                                                                        liquidations[2])
+    liquidator_pl, gas_refunded_eth = calculate_pl_batch(liquidation_keys, liquidation_counts, liquidation_sizes,
+                                                         gas_price, three_min_median, eth_price, params)
+
+    opening_keys = openings[0] * n_minutes + openings[1]
+    self_closed_keys = self_closes[0] * n_minutes + self_closes[1]
+    columns = get_event_minute_columns(n_runs, n_minutes, [opening_keys, liquidation_keys, self_closed_keys])
+
+    n_opened = scatter_to_event_minutes(*columns, opening_keys)
+    n_liquidated = scatter_to_event_minutes(*columns, liquidation_keys, liquidation_counts.astype(float))
+    gas_tank_eth_pl = (n_opened * params['upfront_fee'][:, None] -
+                       scatter_to_event_minutes(*columns, liquidation_keys, gas_refunded_eth))
+    mean_prices = np.cumsum(eth_price)[n_valid - 1] / n_valid  # mean price over each run's valid minutes
+
+    return calculate_metrics_batch(scatter_to_event_minutes(*columns, liquidation_keys, liquidator_pl),
+                                   gas_tank_eth_pl, mean_prices, n_opened,
+                                   scatter_to_event_minutes(*columns, self_closed_keys), n_liquidated,
+                                   scatter_to_event_minutes(*columns, liquidation_keys, liquidation_sizes))
+
+
+def simulate_and_calculate_batch(prices, params_batch, batch_size=BATCH_SIZE):
+    """ simulates and calculates metrics for a structured array or list of param dicts, batch_size runs at a time
+        runs are batched by monthly_opened_streams to limit padding, output rows keep the input order
+        returns the same columns as simulate_and_calculate_n_times """
+    params = get_param_arrays(params_batch)
+    order = np.argsort(params['monthly_opened_streams'], kind='stable')  # similar event counts share a batch
+
+    outputs = []
+    for i in range(0, order.shape[0], batch_size):
+        batch_params = {p: params[p][order[i:i + batch_size]] for p in params}
+        metrics = simulate_and_calculate_metrics_batch(prices, batch_params)
+        outputs.append(pd.DataFrame({**batch_params, **metrics}, index=order[i:i + batch_size]))
+
+    return pd.concat(outputs).sort_index()
@@ -0,0 +1,241 @@
+#########
+# Benchmark suite on synthetic price data, times each stage of a simulation run, gas prediction at several horizons,
+# calculate_metrics and a small run.py-style sweep, and flags regressions against a saved baseline
+# usage: python benchmark.py --durations 1w 6m 5y --save-baseline
+#        python benchmark.py --durations 1w 6m 5y  (exits with 1 if a benchmark regressed)
+#########
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng
+
+from simulation_functions import (simulate_streams, simulate_streams_and_liquidations, calculate_liquidator_pl,
+                                  calculate_liquidator_pl_with_prediction, calculate_gas_tank_pl, calculate_pl,
+                                  simulate_and_calculate_pl)
+from metrics_extraction import calculate_metrics
+from simulation_state import SimulationState
+from synthetic_prices import generate_price_data
+from sweep_runner import set_module_rngs, run_manifest_sweep
+
+BASELINE_PATH = 'benchmark_baseline.json'
+DEFAULT_DURATIONS = ['1w', '1m', '6m']
+PREDICTION_HORIZONS = [.25, .5, 1, 2]  # hours
+MIN_TIMING_SECONDS = .2
+N_REPEATS = 9
+TOLERANCE = .3  # throughput or peak memory this fraction worse than baseline is a regression, above timing noise
+MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and kilobytes on linux
+
+# mid-range params, fixed so every run of the suite does the same work
+BENCHMARK_PARAMS = {
+    'upfront_fee': .025,
+    'upfront_hours': 4,
+    'monthly_opened_streams': 1000,
+    'average_stream_lifetime': 30,
+    'percent_accidently_liquidated_per_month': 5,
+    'average_stream_size': 1000,
+    'refund_rate': .5,
+    'min_self_liquidation_savings': 10,
+    'gas_prediction_ability': 0,
+    'lowest_stream_cost_ratio': 1.5,
+    'distribution_inverse_skewness': 2,
+}
+
+
+####
+# timing
+####
+
+def time_run(run, n_repeats):
+    """ returns the median seconds per call of n_repeats timings and the peak traced memory of one more call
+        each timing loops over enough calls to take MIN_TIMING_SECONDS, so short stages aren't lost in timer noise
+        tracemalloc sees numpy's allocations, the peak is measured on its own call since tracing slows calls down """
+    n_calls, seconds = 1, 0
+    while seconds < MIN_TIMING_SECONDS:  # also warms up caches and the first call's allocations
+        n_calls *= 2
+        start = time.perf_counter()
+        for i in range(n_calls):
+            run()
+        seconds = time.perf_counter() - start
+
+    timings = []
+    for i in range(n_repeats):
+        start = time.perf_counter()
+        for j in range(n_calls):
+            run()
+        timings.append((time.perf_counter() - start) / n_calls)
+
+    tracemalloc.start()
+    run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return np.median(timings), peak_memory
+
+
+def get_stage_runs(df, params=BENCHMARK_PARAMS, seed=0):
+    """ returns benchmark name -> function for every timed stage of one simulation run on df
+        P&L stages reuse one simulated state, so they time the same events however often the other stages run """
+    set_module_rngs(default_rng(seed))
+    state = simulate_streams_and_liquidations(SimulationState(df), params)
+    simulation_state = SimulationState(df)
+
+    def seeded(function):
+        """ stages that draw streams restart from the seed, so every call simulates the same streams """
+        def run():
+            set_module_rngs(default_rng(seed))
+            return function(simulation_state, params)
+
+        return run
+
+    def on_full_state(function, run_params=params):
+        """ gas prediction cuts the state's rows, so stages that write P&L start from every minute again """
+        def run():
+            state.reset()
+            return function(state, run_params)
+
+        return run
+
+    return {
+        'simulate_streams': seeded(simulate_streams),
+        'simulate_streams_and_liquidations': seeded(simulate_streams_and_liquidations),
+        'calculate_liquidator_pl': on_full_state(calculate_liquidator_pl),
+        'calculate_gas_tank_pl': on_full_state(calculate_gas_tank_pl),
+        'calculate_pl': lambda: calculate_pl(state, params),
+        'calculate_metrics': lambda: calculate_metrics(state, params),
+        'simulate_and_calculate_pl': seeded(simulate_and_calculate_pl),
+        **{'calculate_liquidator_pl_with_prediction_{:g}h'.format(hours): on_full_state(
+            calculate_liquidator_pl_with_prediction, {**params, 'gas_prediction_ability': hours})
+           for hours in PREDICTION_HORIZONS},
+    }
+
+
+def measure_sweep(df, n_sims, n_workers, seed, queue):
+    """ runs a seeded sweep end to end and puts its seconds per simulation and peak memory on queue
+        meant to run in its own process, so ru_maxrss only covers this sweep's pool workers """
+    with tempfile.TemporaryDirectory() as sweep_dir:
+        start = time.perf_counter()
+        run_manifest_sweep(df, sweep_dir, n_sims, chunk_size=max(n_sims // (4 * n_workers), 1), n_workers=n_workers,
+                           seed=seed)
+        seconds = time.perf_counter() - start
+
+    queue.put((seconds / n_sims, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * MAXRSS_BYTES))
+
+
+def time_sweep(df, n_sims, n_workers, seed=0):
+    """ times a run.py-style sweep, every simulation index draws its params from its own seed, so each run does the
+        same work, peak memory is the largest resident size of any of its worker processes """
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_sweep, args=(df, n_sims, n_workers, seed, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def run_benchmarks(durations=DEFAULT_DURATIONS, n_repeats=N_REPEATS, seed=0, sweep_sims=32, sweep_workers=4):
+    """ runs every benchmark on synthetic data of each duration, returns a df of seconds per run, runs per second and
+        peak memory """
+    results = []
+    for duration in durations:
+        df = generate_price_data(duration, seed)
+        with np.errstate(divide='ignore', invalid='ignore'):  # metrics of runs without liquidations are nan
+            runs = {name: time_run(run, n_repeats) for name, run in get_stage_runs(df, seed=seed).items()}
+        if sweep_sims:
+            runs['sweep'] = time_sweep(df, sweep_sims, sweep_workers, seed)
+
+        for name, (seconds, peak_memory) in runs.items():
+            results.append({'benchmark': name, 'duration': duration, 'n_minutes': df.shape[0],
+                            'seconds_per_run': seconds, 'runs_per_second': 1 / seconds,
+                            'peak_memory_mb': peak_memory / 2 ** 20})
+
+    return pd.DataFrame(results)
+
+
+####
+# baseline
+####
+
+def get_machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': mp.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def save_baseline(results_df, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': get_machine_info(),
+                   'results': results_df.to_dict('records')}, f, indent=1)
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_to_baseline(results_df, baseline, tolerance=TOLERANCE):
+    """ joins results to the baseline's, regression marks throughput or peak memory more than tolerance worse """
+    baseline_df = pd.DataFrame(baseline['results'])[['benchmark', 'duration', 'runs_per_second', 'peak_memory_mb']]
+    comparison = results_df.merge(baseline_df, on=['benchmark', 'duration'], suffixes=('', '_baseline'))
+    comparison['throughput_ratio'] = comparison['runs_per_second'] / comparison['runs_per_second_baseline']
+    comparison['memory_ratio'] = comparison['peak_memory_mb'] / comparison['peak_memory_mb_baseline']
+    comparison['regression'] = ((comparison['throughput_ratio'] < 1 - tolerance) |
+                                (comparison['memory_ratio'] > 1 + tolerance))
+
+    return comparison
+
+
+####
+# command line
+####
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the simulation on synthetic price data.')
+    parser.add_argument('--durations', nargs='+', default=DEFAULT_DURATIONS,
+                        help='synthetic data lengths, 1w, 1m, 6m, 1y, 5y or n minutes')
+    parser.add_argument('--repeats', type=int, default=N_REPEATS, help='timings per benchmark, the median is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data and the simulations')
+    parser.add_argument('--sweep-sims', type=int, default=32, help='n simulations of the sweep benchmark, 0 skips it')
+    parser.add_argument('--sweep-workers', type=int, default=4, help='n pool workers of the sweep benchmark')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline json to compare to or save')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed fraction worse than baseline')
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    durations = [int(d) if d.isdigit() else d for d in args.durations]
+    results_df = run_benchmarks(durations, args.repeats, args.seed, args.sweep_sims, args.sweep_workers)
+
+    if args.save_baseline:
+        save_baseline(results_df, args.baseline)
+        print(results_df.to_string(index=False))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(results_df.to_string(index=False))
+        print('no baseline at {}, run with --save-baseline to create one'.format(args.baseline))
+        return 1
+
+    comparison = compare_to_baseline(results_df, load_baseline(args.baseline), args.tolerance)
+    print(comparison[['benchmark', 'duration', 'runs_per_second', 'throughput_ratio', 'peak_memory_mb',
+                      'memory_ratio', 'regression']].to_string(index=False))
+
+    return int(comparison['regression'].any())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
+import json
+import os
+
+import numpy as np
 import pandas as pd
 
+CACHE_COLUMNS = ['median_gas_price', 'three_min_median', 'price', 'time']
+
 
 def clean_imported_df(df):
     df = df.drop(columns=['Unnamed: 0'])
@@ -8,4 +14,76 @@ def clean_imported_df(df):
     if 'date' in df.columns:
         df['date'] = pd.to_datetime(df['date'])
 
-    return df
\ No newline at end of file
+    return df
+
+
+####
+# binary columnar cache of the price csvs, columns are memory-mapped so processes share their pages
+####
+
+def get_cache_dir(csv_path):
+    """ the cache sits next to its csv, e.g. input_data.csv -> input_data_cache/ """
+    return os.path.splitext(csv_path)[0] + '_cache'
+
+
+def get_source_signature(csv_path):
+    """ size and modification time identify the version of the csv a cache was built from """
+    stat = os.stat(csv_path)
+
+    return {'source': os.path.basename(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_cache_manifest(cache_dir):
+    """ returns the cache manifest or None if there is no complete cache """
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_cache_valid(csv_path, columns, cache_dir):
+    """ checks the cache was built from the current csv and holds every requested column """
+    manifest = read_cache_manifest(cache_dir)
+
+    return (manifest is not None and manifest['signature'] == get_source_signature(csv_path) and
+            set(columns) <= set(manifest['dtypes']))
+
+
+def build_price_cache(csv_path, columns=CACHE_COLUMNS, cache_dir=None):
+    """ parses the csv once and saves each column as a .npy file, float64 for prices and int64 ns for datetimes
+        the manifest is written last, so an interrupted build is never mistaken for a valid cache """
+    cache_dir = cache_dir or get_cache_dir(csv_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    signature = get_source_signature(csv_path)
+    df = clean_imported_df(pd.read_csv(csv_path))
+
+    dtypes = {}
+    for column in columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            values, dtypes[column] = df[column].to_numpy().astype('datetime64[ns]').view(np.int64), 'datetime64[ns]'
+        else:
+            values, dtypes[column] = df[column].to_numpy(dtype=float), 'float64'
+        with open(os.path.join(cache_dir, column + '.npy.tmp'), 'wb') as f:
+            np.save(f, values)
+        os.replace(os.path.join(cache_dir, column + '.npy.tmp'), os.path.join(cache_dir, column + '.npy'))
+
+    with open(os.path.join(cache_dir, 'manifest.json.tmp'), 'w') as f:
+        json.dump({'signature': signature, 'n_rows': df.shape[0], 'dtypes': dtypes}, f)
+    os.replace(os.path.join(cache_dir, 'manifest.json.tmp'), os.path.join(cache_dir, 'manifest.json'))
+
+
+def load_price_data(csv_path, columns=CACHE_COLUMNS, cache_dir=None):
+    """ returns a df of read-only memory-mapped columns, (re)building the cache if the csv changed
+        drop-in for clean_imported_df(pd.read_csv(csv_path)) limited to the columns the simulator uses """
+    cache_dir = cache_dir or get_cache_dir(csv_path)
+    if not is_cache_valid(csv_path, columns, cache_dir):
+        build_price_cache(csv_path, columns, cache_dir)
+
+    dtypes = read_cache_manifest(cache_dir)['dtypes']
+    data = {}
+    for column in columns:
+        values = np.load(os.path.join(cache_dir, column + '.npy'), mmap_mode='r')
+        data[column] = values.view(dtypes[column]) if dtypes[column] != 'float64' else values
+
+    return pd.DataFrame(data, copy=False)
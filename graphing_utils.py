@@ -3,35 +3,119 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+PLOT_BUCKETS = 1000  # buckets per line, about one per horizontal pixel of a panel
+BAND_PERCENTILES = (1, 25, 75, 99)  # pairs of band edges, outermost first
 
-def graph_pl(df, title = 'Simulation Run Highlights'):
-    """ graph to verify results, not efficient or pretty """
+
+####
+# decimation
+####
+
+def decimate_min_max(values, n_buckets=PLOT_BUCKETS):
+    """ returns the indices and values of the min and max of each of n_buckets equal buckets, in time order
+        keeps every spike and drawdown visible with at most 2 * n_buckets points, short series are returned whole """
+    values = np.asarray(values, dtype=float)
+    n_values = values.shape[0]
+    if n_values <= 2 * n_buckets:
+        return np.arange(n_values), values
+
+    bucket_size = -(-n_values // n_buckets)
+    n_buckets = -(-n_values // bucket_size)
+    padded = np.pad(values, (0, n_buckets * bucket_size - n_values), mode='edge').reshape(n_buckets, bucket_size)
+    starts = np.arange(n_buckets) * bucket_size
+    min_indices, max_indices = starts + np.argmin(padded, axis=1), starts + np.argmax(padded, axis=1)
+
+    indices = np.minimum(np.stack([np.minimum(min_indices, max_indices), np.maximum(min_indices, max_indices)],
+                                  axis=1).ravel(), n_values - 1)
+
+    return indices, values[indices]
+
+
+def get_pl_series(df):
+    """ full resolution cumulative series of a P&L df or SimulationState, each cumsum computed once
+        open streams come from the state's ledger, or from opened minus closed streams for a df without one """
+    columns = {c: np.asarray(df[c], dtype=float) for c in ['liquidator_pl', 'gas_tank_eth_pl', 'n_liquidated',
+                                                           'n_self_closed']}
+    n_liquidated, n_self_closed = np.cumsum(columns['n_liquidated']), np.cumsum(columns['n_self_closed'])
+    if 'n_open' in df:
+        n_open = np.asarray(df['n_open'], dtype=float)
+    else:
+        n_open = np.cumsum(np.asarray(df['n_opened'], dtype=float)) - n_self_closed - n_liquidated
+
+    return {'liquidator_pl': np.cumsum(columns['liquidator_pl']),
+            'gas_tank_eth_pl': np.cumsum(columns['gas_tank_eth_pl']),
+            'price': np.asarray(df['price'], dtype=float),
+            'three_min_median': np.asarray(df['three_min_median'], dtype=float),
+            'n_open': n_open,
+            'n_liquidated': n_liquidated,
+            'n_self_closed': n_self_closed}
+
+
+def get_plot_series(df, n_buckets=PLOT_BUCKETS):
+    """ decimated (indices, values) of every graph_pl line, keep the result to redraw a run without recomputing """
+    return {name: decimate_min_max(values, n_buckets) for name, values in get_pl_series(df).items()}
+
+
+####
+# graphs
+####
+
+def graph_pl(df, title = 'Simulation Run Highlights', n_buckets=PLOT_BUCKETS):
+    """ graph to verify results, takes a P&L df, a SimulationState or the output of get_plot_series
+        lines are decimated to n_buckets min / max buckets, so rendering time doesn't grow with the history """
+    series = df if isinstance(df, dict) else get_plot_series(df, n_buckets)
     fig, axs = plt.subplots(3, 2, figsize=(14, 8))
     colors = sns.color_palette('bright')
     for i, ax in enumerate(axs.flat):
         if i == 0:
-            ax.plot(df['liquidator_pl'].cumsum(), color=colors[0])
+            ax.plot(*series['liquidator_pl'], color=colors[0])
             ax.set_title('Liquidator Profit & Loss (USD)', fontsize=13)
         elif i == 1:
-            ax.plot(df['gas_tank_eth_pl'].cumsum(), color=colors[0])
+            ax.plot(*series['gas_tank_eth_pl'], color=colors[0])
             ax.set_title('Gas Tank Profit & Loss (ETH)', fontsize=13)
         elif i == 2:
-            ax.plot(df['price'], color=colors[1])
+            ax.plot(*series['price'], color=colors[1])
             ax.set_title('Price of Ether', fontsize=13)
         elif i == 3:
-            ax.plot(df['three_min_median'], color=colors[1])
+            ax.plot(*series['three_min_median'], color=colors[1])
             ax.set_title('3-Minute Median Gas Price', fontsize=13)
         elif i == 4:
-            ax.plot((df['n_opened'].cumsum() - df['n_self_closed'].cumsum() - df['n_liquidated'].cumsum()),
-                    color=colors[2])
+            ax.plot(*series['n_open'], color=colors[2])
             ax.set_title('Number of Open Streams', fontsize=13)
         elif i == 5:
-            ax.plot(df['n_liquidated'].cumsum(), color=colors[2])
+            ax.plot(*series['n_liquidated'], color=colors[2])
             ax.set_title('Number of Liquidations & Self Closed Streams', fontsize=13)
-            ax.plot(df['n_self_closed'].cumsum(), color=colors[3])
+            ax.plot(*series['n_self_closed'], color=colors[3])
             ax.legend(loc='upper left', labels=['Liquidations', 'Self-Closed'], fontsize=12)
         ax.set_xticks([])
         sns.despine(left=True, bottom=True)
 
     fig.suptitle(title, fontsize=16)
-    plt.tight_layout()
\ No newline at end of file
+    plt.tight_layout()
+
+
+def calculate_percentile_bands(runs, percentiles=BAND_PERCENTILES, n_points=PLOT_BUCKETS):
+    """ percentiles across runs of one series, e.g. the 'gas_tank_eth_pl' of get_pl_series for many simulations
+        runs can differ in length, they are read at n_points minutes spread over the shortest one
+        returns the minutes, the median and a (n percentiles x n_points) array """
+    n_minutes = min(run.shape[0] for run in runs)
+    minutes = np.linspace(0, n_minutes - 1, min(n_points, n_minutes)).astype(int)
+    sampled = np.array([run[minutes] for run in runs])
+
+    return minutes, np.median(sampled, axis=0), np.percentile(sampled, percentiles, axis=0)
+
+
+def graph_runs(ax, runs, color=None, percentiles=BAND_PERCENTILES, n_buckets=PLOT_BUCKETS, alpha=.1):
+    """ overlays one series of many runs on ax, as percentile bands around the median, or as decimated lines of
+        every run when percentiles is None """
+    if percentiles is None:
+        for run in runs:
+            ax.plot(*decimate_min_max(run, n_buckets), color=color, alpha=alpha)
+        return ax
+
+    minutes, median, bands = calculate_percentile_bands(runs, percentiles, n_buckets)
+    for i in range(len(percentiles) // 2):  # outermost band first, inner bands shade darker on top
+        ax.fill_between(minutes, bands[i], bands[-1 - i], color=color, alpha=alpha * (i + 1), linewidth=0)
+    ax.plot(minutes, median, color=color)
+
+    return ax
@@ -0,0 +1,162 @@
+####
+# opt-in per-stage instrumentation, records wall time, array sizes and event counters of every instrumented call and
+# the param set of the run it belongs to
+# enabled by setting SIM_INSTRUMENT=1 or calling enable(), while disabled an instrumented call costs one dict lookup
+# pool workers return their records with each work unit, so the parent can report on the whole sweep
+####
+
+import functools
+import itertools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+ENV_VARIABLE = 'SIM_INSTRUMENT'
+STAGES_REPORT_NAME = 'instrumentation_stages.csv'
+RUNS_REPORT_NAME = 'instrumentation_runs.csv'
+
+settings = {'enabled': os.environ.get(ENV_VARIABLE, '0') not in ('', '0')}
+records = []  # one dict per finished instrumented call in this process
+runs = {}  # run id -> params of every run started in this process
+open_stages = []  # records of the instrumented calls in progress, innermost last
+run_ids = itertools.count()
+current_run = {'id': None}
+
+
+####
+# switches
+####
+
+def enable():
+    settings['enabled'] = True
+
+
+def disable():
+    settings['enabled'] = False
+
+
+def is_enabled():
+    return settings['enabled']
+
+
+####
+# recording
+####
+
+def get_n_elements(args):
+    """ total size of the array arguments of a call, a SimulationState counts as its n minutes """
+    return sum(arg.size if isinstance(arg, np.ndarray) else getattr(arg, 'n_minutes', 0) for arg in args)
+
+
+def instrument(stage):
+    """ decorator that records each call's wall time and array sizes under stage while instrumentation is enabled """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not settings['enabled']:
+                return function(*args, **kwargs)
+
+            record = {'stage': stage, 'run': current_run['id'], 'depth': len(open_stages),
+                      'n_elements': get_n_elements(args)}
+            open_stages.append(record)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record['seconds'] = time.perf_counter() - start
+                open_stages.pop()
+                records.append(record)
+
+        return wrapper
+
+    return decorator
+
+
+def add_counts(**counts):
+    """ adds counters, e.g. n_events, to the innermost instrumented call in progress """
+    if settings['enabled'] and open_stages:
+        for key, value in counts.items():
+            open_stages[-1][key] = open_stages[-1].get(key, 0) + value
+
+
+def start_run(params):
+    """ marks the following records as belonging to a run of params, ids are unique across pool workers """
+    if settings['enabled']:
+        current_run['id'] = '{}-{}'.format(os.getpid(), next(run_ids))
+        runs[current_run['id']] = dict(params)
+
+
+def start_batch_run(params_batch):
+    """ start_run for a structured array of param sets run by one batched call, whose stages can't be split by set
+        the run is recorded with its n param sets and the mean of each param """
+    if settings['enabled']:
+        start_run({'n_param_sets': params_batch.shape[0],
+                   **{p: float(np.mean(params_batch[p])) for p in params_batch.dtype.names}})
+
+
+####
+# collection across workers
+####
+
+def collect_records():
+    """ returns and clears this process's records and runs, called in a pool worker after each work unit """
+    collected = {'records': records[:], 'runs': dict(runs)}
+    records.clear()
+    runs.clear()
+
+    return collected
+
+
+def merge_records(collected):
+    """ adds records collected in a pool worker to this process's """
+    records.extend(collected['records'])
+    runs.update(collected['runs'])
+
+
+def clear_records():
+    records.clear()
+    runs.clear()
+
+
+####
+# reports
+####
+
+def summarize_stages(stage_records=None):
+    """ returns calls, total and mean seconds, 99th percentile seconds and summed counters per stage """
+    df = pd.DataFrame(records if stage_records is None else stage_records)
+    if df.empty:
+        return df
+
+    counters = [c for c in df.columns if c not in ('stage', 'run', 'depth', 'seconds')]
+    summary = df.groupby('stage').agg(n_calls=('seconds', 'size'), total_seconds=('seconds', 'sum'),
+                                      mean_seconds=('seconds', 'mean'),
+                                      p99_seconds=('seconds', lambda s: np.percentile(s, 99)))
+    summary = summary.join(df.groupby('stage')[counters].sum())
+
+    return summary.sort_values('total_seconds', ascending=False).reset_index()
+
+
+def summarize_runs(stage_records=None, run_params=None):
+    """ returns every run's params with its seconds per stage, slowest runs first, to find slow corners of the params
+        nested stages are counted in their own and their callers' columns, total_seconds only counts outermost calls """
+    df = pd.DataFrame(records if stage_records is None else stage_records)
+    run_params = runs if run_params is None else run_params
+    if df.empty or df['run'].isna().all():
+        return pd.DataFrame()
+
+    df = df.dropna(subset=['run'])
+    stage_seconds = df.pivot_table(index='run', columns='stage', values='seconds', aggfunc='sum')
+    stage_seconds['total_seconds'] = df.loc[df['depth'] == 0].groupby('run')['seconds'].sum()
+    summary = pd.DataFrame.from_dict(run_params, orient='index').join(stage_seconds, how='inner')
+
+    return summary.sort_values('total_seconds', ascending=False).rename_axis('run').reset_index()
+
+
+def write_reports(output_dir):
+    """ writes the stage and run summaries as csvs to output_dir """
+    os.makedirs(output_dir, exist_ok=True)
+    summarize_stages().to_csv(os.path.join(output_dir, STAGES_REPORT_NAME), index=False)
+    summarize_runs().to_csv(os.path.join(output_dir, RUNS_REPORT_NAME), index=False)
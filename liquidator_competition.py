@@ -0,0 +1,192 @@
+#########
+# These functions let several liquidators compete for every liquidation, each with its own gas prediction horizon,
+# gas cost basis and priority bid, optionally behind an auctioned monopoly window for one of them
+# every liquidator's most profitable execution of every liquidation is found in one find_best_executions call, and the
+# winners are picked with one lexsort, so there is no loop over events
+#########
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from simulation_functions import (stream_rate_to_margin, month_to_minute, find_best_executions, calculate_gas_tank_pl,
+                                  simulate_streams_and_liquidations)
+from metrics_extraction import calculate_metrics, calculate_max_drawdown
+from simulation_state import SimulationState
+from instrumentation import instrument, add_counts
+
+# gas_prediction_ability in hours like the params, cost_factor scales the gas a liquidator pays net of refunds, e.g. for
+# cheaper infrastructure, and bid_fraction is the share of its profit it bids as priority fee to win same-minute ties
+LIQUIDATOR_PARAMS = ['gas_prediction_ability', 'cost_factor', 'bid_fraction']
+DEFAULT_LIQUIDATORS = [
+    {'gas_prediction_ability': 0, 'cost_factor': 1, 'bid_fraction': 0},
+    {'gas_prediction_ability': .5, 'cost_factor': 1, 'bid_fraction': .1},
+    {'gas_prediction_ability': 2, 'cost_factor': .8, 'bid_fraction': .05},
+]
+
+EXECUTION_GAS_COLUMN = 'median_gas_price'  # every liquidator pays the same gas price as the single liquidator
+
+# minutes after a liquidation becomes possible during which only the monopoly holder, a liquidator index, may execute
+AUCTION_DEFAULTS = {'monopoly_minutes': 0, 'monopoly_holder': 0}
+
+
+####
+# execution plans
+####
+
+def get_liquidator_arrays(liquidators):
+    """ converts a list of liquidator dicts into a dict of arrays, one value per liquidator """
+    return {p: np.array([liquidator[p] for liquidator in liquidators], dtype=float) for p in LIQUIDATOR_PARAMS}
+
+
+def get_window_sizes(liquidators):
+    """ n minutes each liquidator searches, the window of calculate_liquidator_pl_with_prediction or just the current
+        minute without prediction """
+    return np.array([max(int(liquidator['gas_prediction_ability'] * 60) - 2, 1)
+                     if liquidator['gas_prediction_ability'] > 3 / 60 else 1 for liquidator in liquidators])
+
+
+def get_start_offsets(n_liquidators, params):
+    """ minutes each liquidator waits before it may execute, everyone but the holder waits out the monopoly """
+    offsets = np.full(n_liquidators, int(params['monopoly_minutes']))
+    offsets[int(params['monopoly_holder'])] = 0
+
+    return offsets
+
+
+@instrument('plan_executions')
+def plan_executions(state, params, liquidators, liquidation_rows):
+    """ finds every liquidator's most profitable execution of every liquidation, all (n liquidators x n liquidations)
+        plans are searched in one find_best_executions call
+        returns (n liquidators x n liquidations) arrays of gas prices paid, profits and minutes waited """
+    n_liquidators, n_liquidations = len(liquidators), liquidation_rows.shape[0]
+    offsets = get_start_offsets(n_liquidators, params)
+    windows = np.maximum(get_window_sizes(liquidators) - offsets, 1)
+    # a cost factor scales what the liquidator pays after refunds, i.e. 1 - refund_rate
+    refund_rates = 1 - get_liquidator_arrays(liquidators)['cost_factor'] * (1 - params['refund_rate'])
+
+    sizes = state['liquidation_size_sum'][liquidation_rows]  # a minute's liquidations are executed together
+    posted_margin = stream_rate_to_margin(sizes, params['upfront_hours'])
+    stream_per_step = month_to_minute(sizes)
+    tx_counts = state['n_liquidated'][liquidation_rows]
+
+    gas_prices, profits, steps = find_best_executions(
+        state[EXECUTION_GAS_COLUMN], (liquidation_rows[None, :] + offsets[:, None]).ravel(),
+        (posted_margin[None, :] - offsets[:, None] * stream_per_step[None, :]).ravel(),
+        np.tile(stream_per_step, n_liquidators), np.tile(state['price'][liquidation_rows], n_liquidators),
+        np.repeat(windows, n_liquidations), np.repeat(refund_rates, n_liquidations), return_steps=True,
+        tx_counts=np.tile(tx_counts, n_liquidators))
+
+    shape = (n_liquidators, n_liquidations)
+    return gas_prices.reshape(shape), profits.reshape(shape), steps.reshape(shape) + offsets[:, None]
+
+
+def resolve_winners(profits, delays, bid_fractions):
+    """ returns the index of the liquidator that executes each liquidation, -1 where none can at a profit
+        the earliest profitable execution lands first, ties go to the higher priority bid, then to the lower index
+        a liquidation nobody can profit from in their window is left unexecuted for the sender to close """
+    unprofitable = ~(profits > 0)
+    bids = np.broadcast_to(-bid_fractions[:, None], profits.shape)
+    winners = np.lexsort((bids, delays, unprofitable), axis=0)[0]
+    winners[np.all(unprofitable, axis=0)] = -1
+
+    return winners
+
+
+####
+# profit & loss
+####
+
+@instrument('calculate_competition_pl')
+def calculate_competition_pl(state, params, liquidators=DEFAULT_LIQUIDATORS):
+    """ resolves the liquidator and minute of every liquidation on a simulated state, writes the winners' P&L and gas
+        prices paid to the state and calculates the gas tank P&L from them
+        every liquidator pays EXECUTION_GAS_COLUMN prices, rows without every liquidator's full window are cut
+        unexecuted liquidations pay no liquidator and draw no refund
+        returns the state and a dict of the (n liquidators x n rows) P&L, the liquidation rows, winners and delays,
+        winners are -1 and delays nan for unexecuted liquidations """
+    params = {**AUCTION_DEFAULTS, **params}
+    bid_fractions = get_liquidator_arrays(liquidators)['bid_fraction']
+    state.reset()
+
+    reach = np.max(get_start_offsets(len(liquidators), params) + get_window_sizes(liquidators))
+    output_n_rows = state.n_minutes - reach + 1
+    liquidation_rows = np.flatnonzero(state['n_liquidated'][:output_n_rows] > 0)
+    add_counts(n_liquidations=liquidation_rows.shape[0], n_liquidators=len(liquidators))
+
+    gas_prices, profits, delays = plan_executions(state, params, liquidators, liquidation_rows)
+    winners = resolve_winners(profits, delays, bid_fractions)
+    columns = np.flatnonzero(winners >= 0)
+    winners_executed, rows_executed = winners[columns], liquidation_rows[columns]
+    winner_profits = profits[winners_executed, columns]
+    winner_profits -= bid_fractions[winners_executed] * winner_profits  # priority fee, lost to block producers
+
+    state.n_rows = output_n_rows
+    liquidator_pls = np.zeros((len(liquidators), output_n_rows))
+    liquidator_pls[winners_executed, rows_executed] = winner_profits
+    state['liquidator_pl'][:] = 0
+    state['liquidator_pl'][rows_executed] = winner_profits
+    state['gas_price_paid'][:] = 0  # unexecuted rows refund no gas
+    state['gas_price_paid'][rows_executed] = gas_prices[winners_executed, columns]
+    calculate_gas_tank_pl(state, params, 'gas_price_paid')
+
+    winner_delays = np.full(liquidation_rows.shape[0], np.nan)
+    winner_delays[columns] = delays[winners_executed, columns]
+
+    return state, {'liquidator_pls': liquidator_pls, 'liquidation_rows': liquidation_rows, 'winners': winners,
+                   'delays': winner_delays}
+
+
+def calculate_competition_metrics(state, params, competition):
+    """ calculate_metrics for the combined liquidators and the gas tank, plus each liquidator's profit, max drawdown,
+        share of liquidations executed and mean minutes waited under liquidator_{i}_ keys and the share nobody
+        executed, shares are 0 for a run without liquidations """
+    metrics = calculate_metrics(state, params)
+    counts = state['n_liquidated'][competition['liquidation_rows']]
+    n_liquidations = np.sum(counts)
+
+    def get_share(mask):
+        return np.sum(counts[mask]) / n_liquidations if n_liquidations > 0 else 0.
+
+    metrics['unexecuted_share'] = get_share(competition['winners'] < 0)
+    for i, liquidator_pl in enumerate(competition['liquidator_pls']):
+        cumsum = np.cumsum(liquidator_pl, out=state.get_scratch(0))
+        won = competition['winners'] == i
+        metrics.update({
+            'liquidator_{}_profit'.format(i): cumsum[-1],
+            'liquidator_{}_md'.format(i): calculate_max_drawdown(cumsum, buffer=state.get_scratch(1)),
+            'liquidator_{}_share'.format(i): get_share(won),
+            'liquidator_{}_mean_delay'.format(i): np.mean(competition['delays'][won]) if np.any(won) else np.nan,
+        })
+
+    return metrics
+
+
+####
+# aggregate functions
+####
+
+def simulate_competition(state, params, liquidators=DEFAULT_LIQUIDATORS):
+    """ simulates streams and resolves the competition for them, a df is wrapped in a new SimulationState
+        returns the state and the competition dict of calculate_competition_pl """
+    if not isinstance(state, SimulationState):
+        state = SimulationState(state)
+
+    return calculate_competition_pl(simulate_streams_and_liquidations(state, params), params, liquidators)
+
+
+def sweep_auction(df, params, grid, n_sims=10, liquidators=DEFAULT_LIQUIDATORS):
+    """ calculates competition metrics for every combination of the auction or P&L param values in grid, e.g.
+        {'monopoly_minutes': [0, 5, 15], 'monopoly_holder': [0, 1, 2]}, with the other params fixed
+        each of the n_sims stream draws is reused for every combination, only the competition is resolved again """
+    state = SimulationState(df)
+    results = []
+    for sim in range(n_sims):
+        state = simulate_streams_and_liquidations(state, params)
+        for values in itertools.product(*grid.values()):
+            run_params = {**params, **dict(zip(grid, values))}
+            state, competition = calculate_competition_pl(state, run_params, liquidators)
+            results.append({'sim': sim, **run_params, **calculate_competition_metrics(state, run_params, competition)})
+
+    return pd.DataFrame(results)
@@ -2,35 +2,65 @@
 # functions to extract metrics from Superfluid simulation runs
 ####
 
-import pandas as pd
 import numpy as np
 
+from simulation_state import SimulationState
+from instrumentation import instrument
 
-def calculate_max_drawdown(values):
-    """ returns max drawdown value and time for drawdown to occur """
-    maxes = np.maximum.accumulate(values)
-    drawdowns = maxes - values
+METRIC_COLUMNS = ['liquidator_pl', 'gas_tank_eth_pl', 'n_opened', 'n_self_closed', 'n_liquidated',
+                  'liquidation_size_sum']
+
+
+def calculate_max_drawdown(values, buffer=None):
+    """ returns max drawdown value and time for drawdown to occur
+        buffer is an optional array of the same shape for the running maxes and drawdowns """
+    maxes = np.maximum.accumulate(values, out=buffer)
+    drawdowns = np.subtract(maxes, values, out=buffer)
     drawdown_end_index = np.argmax(drawdowns)
     drawdown_start_index = 0 if drawdown_end_index == 0 else np.argmax(values[:drawdown_end_index])
 
     return values[drawdown_start_index] - values[drawdown_end_index]
 
 
-def calculate_metrics(df, params):
-    """ calculates max drawdown, time to max drawdown and P&Ls """
-    liquidator_pl_cumsum = np.array(df['liquidator_pl'].cumsum())
-    gas_tank_usd_pl_cumsum = np.array(df['gas_tank_eth_pl'].cumsum() * np.mean(df['price']))
+def calculate_max_drawdowns(values):
+    """ returns max drawdown value for each row of a 2-D array of cumulative values
+        same result as calculate_max_drawdown since the drawdown start is the running max at the drawdown end """
+    return np.max(np.maximum.accumulate(values, axis=1) - values, axis=1)
+
+
+def get_metrics_state(df):
+    """ wraps a P&L df in a SimulationState for calculate_metrics, which would fill missing columns with zeros
+        dfs saved before size sums were binned get liquidation_size_sum from avg_liquidation_size * n_liquidated """
+    if 'liquidation_size_sum' not in df and 'avg_liquidation_size' in df and 'n_liquidated' in df:
+        df = df.assign(liquidation_size_sum=np.asarray(df['avg_liquidation_size']) * np.asarray(df['n_liquidated']))
+    missing = [column for column in METRIC_COLUMNS if column not in df]
+    if missing:
+        raise ValueError('P&L df is missing the columns {} needed for its metrics'.format(missing))
+
+    return SimulationState(df)
+
+
+@instrument('calculate_metrics')
+def calculate_metrics(state, params):
+    """ calculates max drawdown, time to max drawdown and P&Ls
+        takes a SimulationState, whose scratch buffers hold the cumsums, or a df """
+    if not isinstance(state, SimulationState):
+        state = get_metrics_state(state)
+
+    liquidator_pl_cumsum = np.cumsum(state['liquidator_pl'], out=state.get_scratch(0))
+    gas_tank_usd_pl_cumsum = np.cumsum(state['gas_tank_eth_pl'], out=state.get_scratch(1))
+    gas_tank_usd_pl_cumsum *= np.mean(state['price'])
 
     total_profit = liquidator_pl_cumsum[-1] + gas_tank_usd_pl_cumsum[-1]
+    liquidator_percent_of_profit = liquidator_pl_cumsum[-1] / total_profit
 
-    liquidator_md = calculate_max_drawdown(liquidator_pl_cumsum)
-    gas_tank_md = calculate_max_drawdown(gas_tank_usd_pl_cumsum)
+    liquidator_md = calculate_max_drawdown(liquidator_pl_cumsum, buffer=state.get_scratch(2))
+    gas_tank_md = calculate_max_drawdown(gas_tank_usd_pl_cumsum, buffer=state.get_scratch(2))
     liquidator_md_percent = liquidator_md / (liquidator_md + gas_tank_md)
-    liquidator_percent_of_profit = liquidator_pl_cumsum[-1] / total_profit
 
-    n_opened = np.sum(df['n_opened'])
-    n_streams_self_closed = np.sum(df['n_self_closed'])
-    n_streams_liquidated = np.sum(df['n_liquidated'])
+    n_opened = np.sum(state['n_opened'])
+    n_streams_self_closed = np.sum(state['n_self_closed'])
+    n_streams_liquidated = np.sum(state['n_liquidated'])
     percent_self_closed = n_streams_self_closed / (n_streams_self_closed + n_streams_liquidated)
     percent_closed = (n_streams_self_closed + n_streams_liquidated) / n_opened
 
@@ -40,8 +70,101 @@ def calculate_metrics(df, params):
         'liquidator_md_percent': liquidator_md_percent,
         'liquidator_percent_of_profit': liquidator_percent_of_profit,
         'total_profit': total_profit,
-        'n_opened': np.sum(df['n_opened']),
+        'n_opened': n_opened,
         'percent_self_closed': percent_self_closed,
         'percent_closed': percent_closed,
-        'total_margin_taken': np.sum(df['n_liquidated'] * df['avg_liquidation_size']),
-    }
\ No newline at end of file
+        'total_margin_taken': np.sum(state['liquidation_size_sum']),
+    }
+
+
+def create_running_drawdown():
+    return {'total': 0., 'max': -np.inf, 'max_drawdown': 0.}
+
+
+def update_running_drawdown(drawdown, values, buffer):
+    """ continues a cumsum and its max drawdown over the next chunk of per-minute values in place
+        the carried total is added to the first value before the cumsum, so the sums match one cumsum over all chunks
+        buffer is a scratch array of the same shape as values, a chunk without values leaves drawdown as it is """
+    if values.shape[0] == 0:
+        return
+
+    buffer[:] = values
+    buffer[0] += drawdown['total']
+    np.cumsum(buffer, out=buffer)
+    drawdown['total'] = buffer[-1]
+
+    maxes = np.maximum.accumulate(buffer)
+    np.maximum(maxes, drawdown['max'], out=maxes)
+    drawdown['max'] = maxes[-1]
+    drawdown['max_drawdown'] = max(drawdown['max_drawdown'], np.max(maxes - buffer))
+
+
+def create_running_metrics():
+    """ accumulators for calculating metrics over a run one chunk of minutes at a time """
+    return {'liquidator': create_running_drawdown(), 'gas_tank_eth': create_running_drawdown(), 'price_sum': 0.,
+            'n_minutes': 0, 'n_opened': 0., 'n_self_closed': 0., 'n_liquidated': 0., 'total_margin_taken': 0.}
+
+
+def update_running_metrics(running, state):
+    """ folds the valid minutes of a chunk's SimulationState into running metrics in place """
+    update_running_drawdown(running['liquidator'], state['liquidator_pl'], state.get_scratch(0))
+    update_running_drawdown(running['gas_tank_eth'], state['gas_tank_eth_pl'], state.get_scratch(0))
+
+    running['price_sum'] += np.sum(state['price'])
+    running['n_minutes'] += state.n_rows
+    for column in ('n_opened', 'n_self_closed', 'n_liquidated'):
+        running[column] += np.sum(state[column])
+    running['total_margin_taken'] += np.sum(state['liquidation_size_sum'])
+
+
+def calculate_running_metrics(running):
+    """ calculate_metrics from running metrics, the gas tank drawdown scales with the mean price of the whole run """
+    mean_price = running['price_sum'] / running['n_minutes'] if running['n_minutes'] else np.nan
+    liquidator_md = running['liquidator']['max_drawdown']
+    gas_tank_md = running['gas_tank_eth']['max_drawdown'] * mean_price
+    total_profit = running['liquidator']['total'] + running['gas_tank_eth']['total'] * mean_price
+
+    n_streams_self_closed, n_streams_liquidated = running['n_self_closed'], running['n_liquidated']
+
+    return {
+        'liquidator_md': liquidator_md,
+        'gas_tank_md': gas_tank_md,
+        'liquidator_md_percent': liquidator_md / (liquidator_md + gas_tank_md),
+        'liquidator_percent_of_profit': running['liquidator']['total'] / total_profit,
+        'total_profit': total_profit,
+        'n_opened': running['n_opened'],
+        'percent_self_closed': n_streams_self_closed / (n_streams_self_closed + n_streams_liquidated),
+        'percent_closed': (n_streams_self_closed + n_streams_liquidated) / running['n_opened'],
+        'total_margin_taken': running['total_margin_taken'],
+    }
+
+
+@instrument('calculate_metrics_batch')
+def calculate_metrics_batch(liquidator_pl, gas_tank_eth_pl, mean_prices, n_opened, n_self_closed, n_liquidated,
+                            liquidation_size_sum):
+    """ calculate_metrics for 2-D arrays with one simulation run per row and one minute per column
+        columns may skip minutes without events since every cumsum is flat over them """
+    liquidator_pl_cumsum = np.cumsum(liquidator_pl, axis=1)
+    gas_tank_usd_pl_cumsum = np.cumsum(gas_tank_eth_pl, axis=1) * mean_prices[:, None]
+
+    total_profit = liquidator_pl_cumsum[:, -1] + gas_tank_usd_pl_cumsum[:, -1]
+
+    liquidator_md = calculate_max_drawdowns(liquidator_pl_cumsum)
+    gas_tank_md = calculate_max_drawdowns(gas_tank_usd_pl_cumsum)
+
+    n_opened = np.sum(n_opened, axis=1)
+    n_streams_self_closed = np.sum(n_self_closed, axis=1)
+    n_streams_liquidated = np.sum(n_liquidated, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'liquidator_md': liquidator_md,
+            'gas_tank_md': gas_tank_md,
+            'liquidator_md_percent': liquidator_md / (liquidator_md + gas_tank_md),
+            'liquidator_percent_of_profit': liquidator_pl_cumsum[:, -1] / total_profit,
+            'total_profit': total_profit,
+            'n_opened': n_opened,
+            'percent_self_closed': n_streams_self_closed / (n_streams_self_closed + n_streams_liquidated),
+            'percent_closed': (n_streams_self_closed + n_streams_liquidated) / n_opened,
+            'total_margin_taken': np.sum(liquidation_size_sum, axis=1),
+        }
@@ -0,0 +1,146 @@
+#########
+# These functions resample the historical gas and ETH prices into many price scenarios for tail-risk estimates
+# paths are stitched from day-long blocks of the history, gas is scaled by a switching high gas regime and ETH log
+# returns by a per-path volatility scale, and scenarios are generated in chunks of 2-D arrays so only one chunk is held
+#########
+
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng
+
+from simulation_functions import simulate_and_calculate_pl
+from metrics_extraction import calculate_metrics
+from batch_simulation import simulate_and_calculate_batch
+from simulation_state import PRICE_COLUMNS, SimulationState
+
+BLOCK_MINUTES = 60 * 24  # blocks start a whole number of days apart, so stitched paths keep the daily gas cycle
+SCENARIO_CHUNK_SIZE = 8  # paths generated at once, each chunk holds a few (paths x minutes) arrays
+GAS_REGIME_SCALES = (1., 2.5)  # gas multiplier of the usual and the high gas regime
+GAS_REGIME_SWITCH_PROBABILITIES = (1 / 60, 1 / 14)  # per block chance of leaving the usual and the high regime
+ETH_VOLATILITY_SCALES = (.75, 1.5)  # range of the per-path multiplier of ETH log returns
+TAIL_QUANTILES = [.5, .9, .95, .99]
+
+
+####
+# scenario generation
+####
+
+def create_scenario_source(df, block_minutes=BLOCK_MINUTES):
+    """ historical columns paths are drawn from, ETH as log returns so stitched blocks continue from the last price """
+    gas_price = np.asarray(df['median_gas_price'], dtype=float)
+    eth_price = np.asarray(df['price'], dtype=float)
+    if gas_price.shape[0] < block_minutes:
+        raise ValueError('{} minutes of prices are shorter than one {} minute block'.format(
+            gas_price.shape[0], block_minutes))
+
+    return {'median_gas_price': gas_price,
+            'three_min_median': np.asarray(df['three_min_median'], dtype=float),
+            'log_returns': np.diff(np.log(eth_price), prepend=np.log(eth_price[0])),
+            'start_price': eth_price[0],
+            'block_starts': np.arange(0, gas_price.shape[0] - block_minutes + 1, block_minutes),
+            'block_minutes': block_minutes}
+
+
+def sample_block_indices(source, n_paths, n_minutes, rng):
+    """ returns a (n_paths x n_minutes) array of history rows, each path a sequence of randomly drawn blocks """
+    block_minutes = source['block_minutes']
+    n_blocks = -(-n_minutes // block_minutes)
+    starts = rng.choice(source['block_starts'], (n_paths, n_blocks))
+
+    return (starts[:, :, None] + np.arange(block_minutes)).reshape(n_paths, -1)[:, :n_minutes]
+
+
+def sample_gas_regimes(n_paths, n_blocks, rng):
+    """ returns a (n_paths x n_blocks) array of gas multipliers from a two-state markov chain over blocks
+        the first block starts in the chain's stationary distribution """
+    leave_usual, leave_high = GAS_REGIME_SWITCH_PROBABILITIES
+    switches = rng.uniform(0, 1, (n_paths, n_blocks))
+
+    regimes = np.zeros((n_paths, n_blocks), dtype=int)
+    regimes[:, 0] = switches[:, 0] < leave_usual / (leave_usual + leave_high)
+    for i in range(1, n_blocks):  # only the n blocks are sequential, paths are vectorized
+        regimes[:, i] = regimes[:, i - 1] ^ (switches[:, i] < np.where(regimes[:, i - 1], leave_high, leave_usual))
+
+    return np.array(GAS_REGIME_SCALES)[regimes]
+
+
+def generate_scenarios(source, n_paths, n_minutes, rng):
+    """ returns a dict of (n_paths x n_minutes) median_gas_price, three_min_median and price arrays """
+    indices = sample_block_indices(source, n_paths, n_minutes, rng)
+    gas_scales = np.repeat(sample_gas_regimes(n_paths, -(-n_minutes // source['block_minutes']), rng),
+                           source['block_minutes'], axis=1)[:, :n_minutes]
+    volatility_scales = rng.uniform(*ETH_VOLATILITY_SCALES, (n_paths, 1))
+
+    log_returns = source['log_returns'][indices] * volatility_scales
+    log_returns[:, 0] = 0  # every path starts at the history's first price
+    price = np.exp(np.cumsum(log_returns, axis=1, out=log_returns), out=log_returns)
+    price *= source['start_price']
+
+    return {'median_gas_price': source['median_gas_price'][indices] * gas_scales,
+            'three_min_median': source['three_min_median'][indices] * gas_scales,
+            'price': price}
+
+
+def iterate_scenarios(df, n_scenarios, n_minutes=None, chunk_size=SCENARIO_CHUNK_SIZE, seed=None):
+    """ lazily yields n_scenarios resampled price paths as dicts of (chunk_size x n_minutes) arrays
+        n_minutes defaults to the history's length, longer paths stitch more blocks """
+    source = create_scenario_source(df)
+    n_minutes = n_minutes or source['median_gas_price'].shape[0]
+    rng = default_rng(seed)
+    for i in range(0, n_scenarios, chunk_size):
+        yield generate_scenarios(source, min(chunk_size, n_scenarios - i), n_minutes, rng)
+
+
+def iterate_scenario_prices(df, n_scenarios, n_minutes=None, chunk_size=SCENARIO_CHUNK_SIZE, seed=None):
+    """ yields each scenario's prices as a dict of 1-D row views, ready for SimulationState.load_prices """
+    for chunk in iterate_scenarios(df, n_scenarios, n_minutes, chunk_size, seed):
+        for path in range(chunk['price'].shape[0]):
+            yield {column: chunk[column][path] for column in PRICE_COLUMNS}
+
+
+####
+# simulations over scenarios
+####
+
+def simulate_scenarios(df, params_list, n_scenarios, n_minutes=None, chunk_size=SCENARIO_CHUNK_SIZE, seed=None):
+    """ runs simulate_and_calculate_pl for every param dict in params_list on every scenario, reusing one state
+        returns a df of scenario, param_index, params and metrics rows """
+    state = None
+    results = []
+    for scenario, prices in enumerate(iterate_scenario_prices(df, n_scenarios, n_minutes, chunk_size, seed)):
+        if state is None:
+            state = SimulationState(prices)
+        state.load_prices(prices)
+
+        for param_index, params in enumerate(params_list):
+            state = simulate_and_calculate_pl(state, params)
+            results.append({'scenario': scenario, 'param_index': param_index, **params,
+                            **calculate_metrics(state, params)})
+
+    return pd.DataFrame(results)
+
+
+def simulate_scenarios_batch(df, params_batch, n_scenarios, n_minutes=None, chunk_size=SCENARIO_CHUNK_SIZE,
+                             seed=None):
+    """ simulate_scenarios through the batched kernel, params_batch is a structured array or list of param dicts """
+    results = []
+    for scenario, prices in enumerate(iterate_scenario_prices(df, n_scenarios, n_minutes, chunk_size, seed)):
+        result_df = simulate_and_calculate_batch(prices, params_batch)
+        result_df.insert(0, 'param_index', result_df.index)
+        result_df.insert(0, 'scenario', scenario)
+        results.append(result_df)
+
+    return pd.concat(results, ignore_index=True)
+
+
+def summarize_tail_risk(results_df, metric='gas_tank_md', quantiles=TAIL_QUANTILES):
+    """ per param set mean and quantiles of metric across scenarios, plus the expected shortfall, the mean of the
+        scenarios at or past the highest quantile """
+    grouped = results_df.groupby('param_index')[metric]
+    summary = grouped.quantile(quantiles).unstack()
+    summary.columns = ['{}_q{:g}'.format(metric, q * 100) for q in quantiles]
+    summary.insert(0, metric + '_mean', grouped.mean())
+    summary['{}_es{:g}'.format(metric, quantiles[-1] * 100)] = grouped.apply(
+        lambda values: values[values >= values.quantile(quantiles[-1])].mean())
+
+    return summary.reset_index()
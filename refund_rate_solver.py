@@ -0,0 +1,169 @@
+####
+# functions to solve for the refund rate that balances liquidator and gas tank max drawdowns on one stream draw
+####
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import bisect
+
+from simulation_functions import simulate_streams_and_liquidations, calculate_pl
+from metrics_extraction import calculate_max_drawdowns
+from simulation_state import SimulationState
+from instrumentation import instrument, add_counts
+
+REFUND_RATE_BOUNDS = (.00001, .99999)
+N_REFUND_RATES = 51
+REFUND_RATE_CHUNK_SIZE = 8  # n refund rates whose minute-level cumsums are held in memory at once
+
+
+def calculate_cumulative_pls(state, params, refund_rate):
+    """ returns cumulative liquidator and gas tank P&L in usd for one refund rate on an already simulated state
+        matches the cumsums in calculate_metrics """
+    state = calculate_pl(state, {**params, 'refund_rate': refund_rate})
+    liquidator_pl_cumsum = np.cumsum(state['liquidator_pl'])
+    gas_tank_usd_pl_cumsum = np.cumsum(state['gas_tank_eth_pl']) * np.mean(state['price'])
+
+    return liquidator_pl_cumsum, gas_tank_usd_pl_cumsum
+
+
+def get_change_mask(*cumsums):
+    """ marks the first and last minute and every minute where any cumsum moves
+        cumsums are flat between events, so dropping the other minutes leaves drawdowns and totals unchanged """
+    changed = np.ones(cumsums[0].shape[0], dtype=bool)
+    changed[1:-1] = np.any([np.diff(c)[:-1] != 0 for c in cumsums], axis=0)
+
+    return changed
+
+
+def calculate_affine_cumulative_pls(state, params):
+    """ returns intercepts and slopes of the cumulative P&Ls in the refund rate at minutes where they change
+        without gas prediction both P&Ls are affine in the refund rate, so the 0% and 100% runs define every rate """
+    liquidator_0, gas_tank_0 = calculate_cumulative_pls(state, params, 0)
+    liquidator_1, gas_tank_1 = calculate_cumulative_pls(state, params, 1)
+    changed = get_change_mask(liquidator_0, liquidator_1, gas_tank_0, gas_tank_1)
+    liquidator_0, liquidator_1 = liquidator_0[changed], liquidator_1[changed]
+    gas_tank_0, gas_tank_1 = gas_tank_0[changed], gas_tank_1[changed]
+
+    return liquidator_0, liquidator_1 - liquidator_0, gas_tank_0, gas_tank_1 - gas_tank_0
+
+
+def calculate_balance_metrics(liquidator_pl_cumsums, gas_tank_usd_pl_cumsums):
+    """ calculates liquidator max drawdown percent and percent of profit for each row of cumulative P&Ls """
+    liquidator_md = calculate_max_drawdowns(liquidator_pl_cumsums)
+    gas_tank_md = calculate_max_drawdowns(gas_tank_usd_pl_cumsums)
+    total_profit = liquidator_pl_cumsums[:, -1] + gas_tank_usd_pl_cumsums[:, -1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        liquidator_md_percent = liquidator_md / (liquidator_md + gas_tank_md)
+        liquidator_percent_of_profit = liquidator_pl_cumsums[:, -1] / total_profit
+
+    return liquidator_md_percent, liquidator_percent_of_profit
+
+
+def iterate_affine_cumulative_pls(refund_rates, liquidator_0, liquidator_slope, gas_tank_0, gas_tank_slope,
+                                  chunk_size=REFUND_RATE_CHUNK_SIZE):
+    """ yields cumulative P&L rows for chunks of refund rates from the output of calculate_affine_cumulative_pls """
+    for i in range(0, refund_rates.shape[0], chunk_size):
+        rates = refund_rates[i:i + chunk_size, None]
+        yield liquidator_0 + rates * liquidator_slope, gas_tank_0 + rates * gas_tank_slope
+
+
+def iterate_cumulative_pls(state, params, refund_rates, chunk_size=REFUND_RATE_CHUNK_SIZE):
+    """ yields cumulative P&L rows, compressed to the minutes where they change, for chunks of refund rates
+        with gas prediction the execution minute depends on the refund rate, so each rate is recalculated on the
+        draw """
+    if params['gas_prediction_ability'] <= 3 / 60:
+        yield from iterate_affine_cumulative_pls(refund_rates, *calculate_affine_cumulative_pls(state, params),
+                                                 chunk_size=chunk_size)
+    else:
+        for refund_rate in refund_rates:
+            liquidator, gas_tank = calculate_cumulative_pls(state, params, refund_rate)
+            changed = get_change_mask(liquidator, gas_tank)
+            yield liquidator[None, changed], gas_tank[None, changed]
+
+
+def calculate_curve_metrics(refund_rates, cumulative_pls):
+    """ collects the balance metrics of each yielded chunk of cumulative P&Ls into one df """
+    metrics = [calculate_balance_metrics(liquidator, gas_tank) for liquidator, gas_tank in cumulative_pls]
+    liquidator_md_percent = np.concatenate([m[0] for m in metrics])
+    liquidator_percent_of_profit = np.concatenate([m[1] for m in metrics])
+
+    return pd.DataFrame({'refund_rate': refund_rates,
+                         'liquidator_md_percent': liquidator_md_percent,
+                         'liquidator_percent_of_profit': liquidator_percent_of_profit,
+                         'loss': liquidator_md_percent - liquidator_percent_of_profit})
+
+
+def get_refund_rate_grid(refund_rates=None):
+    """ defaults to N_REFUND_RATES evenly spaced rates inside the old bisect bounds """
+    if refund_rates is None:
+        return np.linspace(*REFUND_RATE_BOUNDS, N_REFUND_RATES)
+
+    return np.asarray(refund_rates, dtype=float)
+
+
+def calculate_refund_rate_curve(state, params, refund_rates=None, chunk_size=REFUND_RATE_CHUNK_SIZE):
+    """ calculates the balance metrics over a grid of refund rates without resampling streams
+        state must already be simulated with simulate_streams_and_liquidations """
+    refund_rates = get_refund_rate_grid(refund_rates)
+
+    return calculate_curve_metrics(refund_rates, iterate_cumulative_pls(state, params, refund_rates, chunk_size))
+
+
+def calculate_refund_rate_loss(refund_rate, state, params):
+    """ liquidator max drawdown percent minus liquidator percent of profit on a fixed simulated state """
+    add_counts(n_bisect_iterations=1)
+    liquidator, gas_tank = calculate_cumulative_pls(state, params, refund_rate)
+    liquidator_md_percent, liquidator_percent_of_profit = calculate_balance_metrics(liquidator[None, :],
+                                                                                    gas_tank[None, :])
+
+    return liquidator_md_percent[0] - liquidator_percent_of_profit[0]
+
+
+def calculate_affine_refund_rate_loss(refund_rate, liquidator_0, liquidator_slope, gas_tank_0, gas_tank_slope):
+    """ same loss as calculate_refund_rate_loss from the output of calculate_affine_cumulative_pls """
+    add_counts(n_bisect_iterations=1)
+    liquidator_md_percent, liquidator_percent_of_profit = calculate_balance_metrics(
+        (liquidator_0 + refund_rate * liquidator_slope)[None, :], (gas_tank_0 + refund_rate * gas_tank_slope)[None, :])
+
+    return liquidator_md_percent[0] - liquidator_percent_of_profit[0]
+
+
+def find_first_sign_change(refund_rates, loss):
+    """ returns the grid cell holding the first root of the loss curve, or None if the loss never changes sign """
+    sign_changes = np.flatnonzero(np.sign(loss[:-1]) * np.sign(loss[1:]) <= 0)  # nan never counts as a change
+
+    return None if sign_changes.shape[0] == 0 else (refund_rates[sign_changes[0]], refund_rates[sign_changes[0] + 1])
+
+
+@instrument('solve_refund_rate')
+def solve_refund_rate(state, params, refund_rates=None):
+    """ finds the refund rate where liquidator max drawdown percent equals its percent of profit
+        scans the loss curve for its first sign change, then bisects inside that grid cell on the same draw
+        returns 0 when the loss never changes sign, like the old bisect fallback """
+    refund_rates = get_refund_rate_grid(refund_rates)
+    add_counts(n_grid_rates=refund_rates.shape[0])
+    if params['gas_prediction_ability'] <= 3 / 60:
+        loss_function, args = calculate_affine_refund_rate_loss, calculate_affine_cumulative_pls(state, params)
+        cumulative_pls = iterate_affine_cumulative_pls(refund_rates, *args)
+    else:
+        loss_function, args = calculate_refund_rate_loss, (state, params)
+        cumulative_pls = iterate_cumulative_pls(state, params, refund_rates)
+
+    curve = calculate_curve_metrics(refund_rates, cumulative_pls)
+    cell = find_first_sign_change(refund_rates, np.array(curve['loss']))
+    if cell is None:
+        return 0
+
+    return bisect(loss_function, *cell, args=args)
+
+
+def simulate_and_solve_refund_rate(state, params):
+    """ samples streams once, sets params['refund_rate'] to the balanced rate and returns the P&L state for that draw
+        a df is wrapped in a new SimulationState """
+    if not isinstance(state, SimulationState):
+        state = SimulationState(state)
+    state = simulate_streams_and_liquidations(state, params)
+    params['refund_rate'] = solve_refund_rate(state, params)
+
+    return calculate_pl(state, params)
@@ -0,0 +1,182 @@
+####
+# append-only columnar store for sweep results with running per-group aggregates
+# every column is a raw binary file, a commit record holds the committed row count and the aggregates, so readers never
+# see a partially written chunk and the headline summaries load without reading any rows
+####
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+COLUMN_DIR = 'columns'
+COMMIT_NAME = 'commit.json'
+
+GROUP_COLUMNS = ['upfront_fee', 'upfront_hours']
+AGGREGATE_METRICS = ['total_profit', 'refund_rate', 'percent_self_closed']
+SUMMARY_QUANTILES = [.01, .25, .5, .75, .99]
+SKETCH_RELATIVE_ACCURACY = .01  # quantiles are within 1% of the true value
+SKETCH_MIN_VALUE = 1e-9  # magnitudes below this count as zero
+
+
+####
+# quantile sketch, log-spaced buckets with a relative accuracy guarantee that merge by adding counts
+####
+
+def get_sketch_gamma(relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def create_sketch():
+    return {'positive': {}, 'negative': {}, 'zero': 0}
+
+
+def add_bucket_counts(store, indices):
+    """ adds one count per index to a bucket -> count dict with json string keys """
+    unique_indices, counts = np.unique(indices, return_counts=True)
+    for i, count in zip(unique_indices, counts):
+        store[str(i)] = store.get(str(i), 0) + int(count)
+
+
+def update_sketch(sketch, values):
+    """ adds the non-nan values to the sketch in place """
+    values = values[~np.isnan(values)]
+    log_gamma = np.log(get_sketch_gamma())
+    for sign, store in ((1, 'positive'), (-1, 'negative')):
+        magnitudes = values[sign * values >= SKETCH_MIN_VALUE] * sign
+        add_bucket_counts(sketch[store], np.ceil(np.log(magnitudes) / log_gamma).astype(int))
+    sketch['zero'] += int(np.sum(np.abs(values) < SKETCH_MIN_VALUE))
+
+
+def get_sketch_quantiles(sketch, quantiles):
+    """ returns estimated quantiles of the values added to the sketch """
+    gamma = get_sketch_gamma()
+    negative = sorted(((int(i), c) for i, c in sketch['negative'].items()), reverse=True)
+    positive = sorted((int(i), c) for i, c in sketch['positive'].items())
+    values = ([-2 * gamma ** i / (gamma + 1) for i, _ in negative] + [0] +
+              [2 * gamma ** i / (gamma + 1) for i, _ in positive])
+    counts = np.cumsum([c for _, c in negative] + [sketch['zero']] + [c for _, c in positive])
+    if counts[-1] == 0:
+        return [np.nan for q in quantiles]
+
+    return [values[np.searchsorted(counts, q * (counts[-1] - 1), side='right')] for q in quantiles]
+
+
+####
+# running moments, merged per chunk with Chan's parallel update
+####
+
+def create_moments():
+    return {'count': 0, 'mean': 0., 'm2': 0.}
+
+
+def update_moments(moments, values):
+    """ merges the mean and sum of squared deviations of the non-nan values into moments in place """
+    values = values[~np.isnan(values)]
+    if values.shape[0] == 0:
+        return
+
+    n_a, n_b = moments['count'], values.shape[0]
+    mean_b = np.mean(values)
+    delta = mean_b - moments['mean']
+    moments['count'] = n_a + n_b
+    moments['mean'] += delta * n_b / (n_a + n_b)
+    moments['m2'] += np.sum((values - mean_b) ** 2) + delta ** 2 * n_a * n_b / (n_a + n_b)
+
+
+def update_aggregates(aggregates, df):
+    """ folds a chunk of results into the per-group moments and sketches of AGGREGATE_METRICS """
+    for group, group_df in df.groupby(GROUP_COLUMNS):
+        key = ','.join(repr(float(g)) for g in group)
+        entry = aggregates.setdefault(key, {'group': [float(g) for g in group], 'metrics': {}})
+        for metric in AGGREGATE_METRICS:
+            if metric not in group_df.columns:
+                continue
+            values = np.asarray(group_df[metric], dtype=float)
+            state = entry['metrics'].setdefault(metric, {'moments': create_moments(), 'sketch': create_sketch()})
+            update_moments(state['moments'], values)
+            update_sketch(state['sketch'], values)
+
+
+####
+# store
+####
+
+def read_commit(store_dir):
+    """ returns the last commit record, an empty store has no rows, schema or aggregates """
+    try:
+        with open(os.path.join(store_dir, COMMIT_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'n_rows': 0, 'schema': {}, 'tags': [], 'aggregates': {}}
+
+
+def write_commit(store_dir, commit):
+    path = os.path.join(store_dir, COMMIT_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(commit, f)
+    os.replace(path + '.tmp', path)
+
+
+def get_column_path(store_dir, column):
+    return os.path.join(store_dir, COLUMN_DIR, column + '.bin')
+
+
+def get_schema(df):
+    """ int columns are stored as int64, bool as bool and everything else as float64 """
+    return {column: ('int64' if pd.api.types.is_integer_dtype(df[column]) else
+                     'bool' if pd.api.types.is_bool_dtype(df[column]) else 'float64') for column in df.columns}
+
+
+def append_results(store_dir, df, tag=None):
+    """ appends a chunk of results and updates the aggregates, committed in one atomic step
+        bytes left past the committed rows by an interrupted append are truncated first
+        tag records e.g. a shard index in the same commit, so completion and rows can't disagree """
+    os.makedirs(os.path.join(store_dir, COLUMN_DIR), exist_ok=True)
+    commit = read_commit(store_dir)
+    schema = commit['schema'] or get_schema(df)
+    if set(df.columns) != set(schema):
+        raise ValueError('result columns {} do not match the store schema {}'.format(list(df.columns), list(schema)))
+
+    for column, dtype in schema.items():
+        with open(get_column_path(store_dir, column), 'ab') as f:
+            f.truncate(commit['n_rows'] * np.dtype(dtype).itemsize)
+            np.asarray(df[column], dtype=dtype).tofile(f)
+
+    update_aggregates(commit['aggregates'], df)
+    commit.update(n_rows=commit['n_rows'] + df.shape[0], schema=schema,
+                  tags=commit['tags'] + ([tag] if tag is not None else []))
+    write_commit(store_dir, commit)
+
+
+def read_results(store_dir, columns=None):
+    """ returns the committed rows as a df of memory-mapped columns """
+    commit = read_commit(store_dir)
+    data = {}
+    for column in columns or list(commit['schema']):
+        dtype = commit['schema'][column]
+        data[column] = (np.memmap(get_column_path(store_dir, column), dtype=dtype, mode='r', shape=(commit['n_rows'],))
+                        if commit['n_rows'] else np.zeros(0, dtype=dtype))
+
+    return pd.DataFrame(data, copy=False)
+
+
+def get_completed_tags(store_dir):
+    return set(read_commit(store_dir)['tags'])
+
+
+def load_group_summary(store_dir, quantiles=SUMMARY_QUANTILES):
+    """ returns count, mean, std and quantiles of AGGREGATE_METRICS per upfront_fee x upfront_hours group
+        reads only the commit record, so it takes the same time for any number of rows """
+    rows = []
+    for entry in read_commit(store_dir)['aggregates'].values():
+        for metric, state in entry['metrics'].items():
+            moments = state['moments']
+            std = np.sqrt(moments['m2'] / (moments['count'] - 1)) if moments['count'] > 1 else np.nan
+            rows.append({**dict(zip(GROUP_COLUMNS, entry['group'])), 'metric': metric, 'count': moments['count'],
+                         'mean': moments['mean'], 'std': std,
+                         **{'q{:g}'.format(q * 100): v for q, v in
+                            zip(quantiles, get_sketch_quantiles(state['sketch'], quantiles))}})
+
+    return pd.DataFrame(rows).sort_values(GROUP_COLUMNS + ['metric']).reset_index(drop=True) if rows else pd.DataFrame()
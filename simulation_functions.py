@@ -8,6 +8,8 @@ from numpy.random import default_rng
 
 from simulation_parameters import sample_params
 from metrics_extraction import calculate_metrics
+from simulation_state import SimulationState
+from instrumentation import instrument, add_counts
 
 pd.options.mode.chained_assignment = None
 rng = default_rng()
@@ -20,6 +22,13 @@ OPEN_GAS = 228000
 LIQUIDATION_GAS = 223000
 STANDARD_TX_GAS = 140000
 
+EXECUTION_CHUNK_SIZE = 2 ** 20  # max elements in one (liquidations x window steps) tile of execution profits
+
+# params that set the stream population, common random draws are shared by variants that only change other params
+DRAW_PARAMS = ['monthly_opened_streams', 'average_stream_lifetime', 'percent_accidently_liquidated_per_month',
+               'average_stream_size', 'distribution_inverse_skewness']
+PAIRED_METRICS = ['total_profit', 'liquidator_md', 'gas_tank_md', 'percent_self_closed']
+
 
 ####
 # conversion functions
@@ -87,6 +96,11 @@ def simulate_naive_liquidation_times(times, sizes, n_minutes, params):
                                rng.exponential(1 / prob_self_closed, n_samples))
     liquidation_mask = np.asarray(rng.uniform(0, 1, n_samples) < prob_closing_tx_is_liquidation)
 
+    return split_stream_ends(times, sizes, liquidation_mask, n_minutes)
+
+
+def split_stream_ends(times, sizes, liquidation_mask, n_minutes):
+    """ splits stream end times and sizes into liquidations and self-closes inside the time window """
     liquidation_times = times[liquidation_mask]
     liquidation_sizes = sizes[liquidation_mask]
     liquidation_times, liquidation_sizes = remove_invalid_times(liquidation_times, liquidation_sizes, n_minutes)
@@ -133,13 +147,18 @@ def simulate_stream_ends(times, sizes, gas_price, eth_price, n_minutes, params):
                                                      self_closed_sizes, gas_price, eth_price, params)
 
 
+def calculate_stream_costs(stream_gas_prices, stream_eth_prices, params):
+    """ lowest stream size a user opens at the given prices """
+    return ((OPEN_GAS * gwei_to_eth(stream_gas_prices) + params['upfront_fee']) *  # upfront fee + gas cost
+            stream_eth_prices * params['lowest_stream_cost_ratio'])  # do we want to add margin here too?
+
+
 def sample_stream_sizes(stream_times, stream_gas_prices, stream_eth_prices, params):
     """ samples stream sizes from gamma distribution and removes those where tx cost > month stream value
         assumes constant stream size distribution over time, so during less streams will be opened on average """
     gamma_k = params['distribution_inverse_skewness']
     theta = params['average_stream_size'] / gamma_k  # based on assumed distribution
-    stream_costs = ((OPEN_GAS * gwei_to_eth(stream_gas_prices) + params['upfront_fee']) *  # upfront fee + gas cost
-                    stream_eth_prices * params['lowest_stream_cost_ratio'])  # do we want to add margin here too?
+    stream_costs = calculate_stream_costs(stream_gas_prices, stream_eth_prices, params)
 
     stream_sizes = rng.gamma(gamma_k, theta, size=stream_times.shape[0])
     opened_streams_mask = np.asarray(stream_sizes > stream_costs)  # streams smaller than current cost not opened
@@ -147,56 +166,75 @@ def sample_stream_sizes(stream_times, stream_gas_prices, stream_eth_prices, para
     return stream_times[opened_streams_mask], stream_sizes[opened_streams_mask]
 
 
-def simulate_streams(df, params):
-    """ simulates stream start and end times, stream sizes, self-closings, liquidations """
-    n_minutes = df.shape[0]
+@instrument('simulate_streams')
+def simulate_streams(state, params):
+    """ simulates stream start and end times, stream sizes, self-closings, liquidations
+        resets the state, a reused state can still be cut short by an earlier gas prediction window """
+    state.reset()
+    n_minutes = state.n_minutes
     new_stream_times = sample_new_stream_times(n_minutes, params)
     # simulate stream sizes
-    new_stream_gas_prices = np.array(df['median_gas_price'])[new_stream_times]
-    new_stream_eth_prices = np.array(df['price'])[new_stream_times]
+    new_stream_gas_prices = state['median_gas_price'][new_stream_times]
+    new_stream_eth_prices = state['price'][new_stream_times]
     new_stream_times, new_stream_sizes = sample_stream_sizes(new_stream_times, new_stream_gas_prices,
                                                              new_stream_eth_prices, params)
 
     liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes = simulate_stream_ends(
-        new_stream_times, new_stream_sizes, np.array(df['median_gas_price']), np.array(df['price']), n_minutes, params)
+        new_stream_times, new_stream_sizes, state['median_gas_price'], state['price'], n_minutes, params)
+    add_counts(n_streams=new_stream_times.shape[0], n_liquidations=liquidation_times.shape[0],
+               n_self_closes=self_closed_times.shape[0])
 
-    return new_stream_times, liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes
+    return (new_stream_times, liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes,
+            new_stream_sizes)
 
 
-def bin_times_and_sizes(times, n_minutes, sizes=False):
-    """ bins the arrivals and avg liquidation sizes into 1 min intervals """
-    unique_values, indices, counts = np.unique(times, return_index=True, return_counts=True)
+@instrument('bin_times_and_sizes')
+def bin_times_and_sizes(times, binned_times, sizes=None, summed_sizes=None, mean_sizes=None):
+    """ bins event counts and the summed and mean sizes of each minute's events into 1 min intervals, overwriting
+        the given buffers, bincount is linear in the events and minutes and needs no sort """
+    add_counts(n_events=times.shape[0])
+    binned_times[:] = np.bincount(times, minlength=binned_times.shape[0])
 
-    binned_times = np.zeros(n_minutes)
-    binned_times[unique_values] = counts
+    if sizes is not None:
+        summed_sizes[:] = np.bincount(times, weights=sizes, minlength=summed_sizes.shape[0])
+    if mean_sizes is not None:
+        mean_sizes[:] = 0
+        np.divide(summed_sizes, binned_times, out=mean_sizes, where=binned_times > 0)
 
-    if type(sizes) == np.ndarray:
-        binned_sizes = np.zeros(n_minutes)
-        binned_sizes[unique_values] = sizes[indices]  # doesn't average sizes if multiple arrivals, but efficient
 
-        return binned_times, binned_sizes
+def update_stream_ledger(state, n_open_start=0, open_size_start=0.):
+    """ turns the binned openings and closes into the open streams and their summed monthly size at the end of every
+        minute, starting from streams already open before the first row, e.g. carried over from an earlier chunk
+        expects open_stream_size to hold each minute's opened sizes, the margin they have posted is
+        stream_rate_to_margin(open_stream_size, upfront_hours) """
+    n_open, open_stream_size = state['n_open'], state['open_stream_size']
+    np.subtract(state['n_opened'], state['n_self_closed'], out=n_open)
+    n_open -= state['n_liquidated']
+    n_open[0] += n_open_start
+    np.cumsum(n_open, out=n_open)
 
-    return binned_times
+    open_stream_size -= state['liquidation_size_sum']
+    open_stream_size -= state['self_closed_size_sum']
+    open_stream_size[0] += open_size_start
+    np.cumsum(open_stream_size, out=open_stream_size)
 
 
-def simulate_streams_and_liquidations(df, params):
-    """ simulates streams and liquidations data """
-    n_minutes = df.shape[0]
-    new_stream_times, liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes = simulate_streams(df,
-                                                                                                                    params)
+def bin_stream_events(state, new_stream_times, liquidation_times, self_closed_times, liquidation_sizes,
+                      self_closed_sizes, new_stream_sizes, n_open_start=0, open_size_start=0.):
+    """ bins openings, liquidations and self-closes into the state's buffers and updates the open stream ledger """
+    bin_times_and_sizes(new_stream_times, state['n_opened'], new_stream_sizes, state['open_stream_size'])
+    bin_times_and_sizes(liquidation_times, state['n_liquidated'], liquidation_sizes, state['liquidation_size_sum'],
+                        state['avg_liquidation_size'])
+    bin_times_and_sizes(self_closed_times, state['n_self_closed'], self_closed_sizes, state['self_closed_size_sum'],
+                        state['avg_self_closed_size'])
+    update_stream_ledger(state, n_open_start, open_size_start)
 
-    df['n_opened'] = bin_times_and_sizes(new_stream_times, n_minutes, sizes=False)
-    liquidation_binned_times, liquidation_binned_sizes = bin_times_and_sizes(liquidation_times, n_minutes,
-                                                                             sizes=liquidation_sizes)
-    self_closed_binned_times, self_closed_binned_sizes = bin_times_and_sizes(self_closed_times, n_minutes,
-                                                                             sizes=self_closed_sizes)
 
-    df['n_liquidated'] = liquidation_binned_times
-    df['n_self_closed'] = self_closed_binned_times
-    df['avg_liquidation_size'] = liquidation_binned_sizes
-    df['avg_self_closed_size'] = self_closed_binned_sizes
+def simulate_streams_and_liquidations(state, params):
+    """ simulates streams and liquidations data into the state's buffers """
+    bin_stream_events(state, *simulate_streams(state, params))
 
-    return df
+    return state
 
 
 ####
@@ -204,71 +242,229 @@ def simulate_streams_and_liquidations(df, params):
 ####
 
 
-def calculate_liquidator_pl(df, params):
-    """ calculates liquidator's profit & loss given no gas prediction capability """
-    return (df['n_liquidated'] * stream_rate_to_margin(df['avg_liquidation_size'], params['upfront_hours']) -
-            LIQUIDATION_GAS * df['n_liquidated'] * gwei_to_eth(df['median_gas_price']) * df['price'] * (
-                    1 - params['refund_rate']))
-
-
-def calculate_liquidator_pl_with_prediction(df, params):
+@instrument('calculate_liquidator_pl')
+def calculate_liquidator_pl(state, params):
+    """ calculates liquidator's profit & loss given no gas prediction capability
+        evaluated in place, in the same order as
+        stream_rate_to_margin(liquidation_size_sum, upfront_hours) -
+        LIQUIDATION_GAS * n_liquidated * gwei_to_eth(median_gas_price) * price * (1 - refund_rate) """
+    liquidator_pl, tx_costs, gas_eth = state['liquidator_pl'], state.get_scratch(0), state.get_scratch(1)
+
+    np.divide(state['liquidation_size_sum'], 30, out=liquidator_pl)
+    liquidator_pl /= 24
+    liquidator_pl *= params['upfront_hours']
+
+    np.multiply(LIQUIDATION_GAS, state['n_liquidated'], out=tx_costs)
+    np.multiply(state['median_gas_price'], 10 ** -9, out=gas_eth)
+    tx_costs *= gas_eth
+    tx_costs *= state['price']
+    tx_costs *= 1 - params['refund_rate']
+    liquidator_pl -= tx_costs
+
+    return liquidator_pl
+
+
+@instrument('find_best_executions')
+def find_best_executions(gas_prices, start_indices, posted_margin, stream_per_step, eth_price, window_size,
+                         refund_rate, chunk_size=EXECUTION_CHUNK_SIZE, return_steps=False, tx_counts=1):
+    """ returns the gas price paid and liquidator profit at the most profitable step of each liquidation's window
+        walks the windows in tiles of at most chunk_size elements so memory stays proportional to n liquidations
+        a liquidation stops being searched once its remaining margin minus the cheapest gas in the data can't beat
+        its best profit so far, which keeps long prediction horizons cheap
+        window_size, refund_rate and tx_counts, the n liquidation txs executed together, are scalars or one value per
+        liquidation
+        return_steps also returns the step of each window the liquidation is executed at """
+    n_rows = start_indices.shape[0]
+    window_sizes = np.broadcast_to(window_size, (n_rows,))
+    refund_factors = np.broadcast_to((1 - np.asarray(refund_rate, dtype=float)) * tx_counts, (n_rows,))
+    best_profits = np.full(n_rows, -np.inf)
+    best_gas_prices = np.zeros(n_rows)
+    best_steps = np.zeros(n_rows, dtype=int)
+    cheapest_tx_costs = LIQUIDATION_GAS * gwei_to_eth(np.nanmin(gas_prices, initial=np.inf)) * eth_price * (
+        refund_factors)
+
+    active = np.flatnonzero(window_sizes > 0)
+    add_counts(n_liquidations=n_rows)
+    offset = 0
+    while active.shape[0] > 0:
+        steps = np.arange(offset, min(offset + max(chunk_size // active.shape[0], 1), np.max(window_sizes[active])))
+        window_indices = np.minimum(start_indices[active, None] + steps[None, :], gas_prices.shape[0] - 1)
+        window_gas_prices = gas_prices[window_indices]
+
+        remaining_margin = posted_margin[active, None] - steps[None, :] * stream_per_step[active, None]
+        tx_costs = LIQUIDATION_GAS * gwei_to_eth(window_gas_prices) * eth_price[active, None] * refund_factors[
+            active, None]
+        liquidator_profits = remaining_margin - tx_costs
+        add_counts(n_tiles=1, n_window_elements=liquidator_profits.size)
+        liquidator_profits[steps[None, :] >= window_sizes[active, None]] = -np.inf  # past a shorter window
+
+        tile_indices = np.argmax(liquidator_profits, axis=1)
+        tile_profits = liquidator_profits[np.arange(active.shape[0]), tile_indices]
+        # strict comparison keeps the earliest step on ties and a nan sticks once found, both like one np.argmax
+        improved = (tile_profits > best_profits[active]) | (np.isnan(tile_profits) & ~np.isnan(best_profits[active]))
+        best_profits[active[improved]] = tile_profits[improved]
+        best_gas_prices[active[improved]] = window_gas_prices[np.arange(active.shape[0]), tile_indices][improved]
+        best_steps[active[improved]] = steps[tile_indices][improved]
+
+        offset = steps[-1] + 1
+        profit_bounds = (posted_margin[active] - offset * stream_per_step[active]) - cheapest_tx_costs[active]
+        active = active[(profit_bounds > best_profits[active]) & (offset < window_sizes[active])]
+
+    if return_steps:
+        return best_gas_prices, best_profits, best_steps
+
+    return best_gas_prices, best_profits
+
+
+@instrument('calculate_liquidator_pl_with_prediction')
+def calculate_liquidator_pl_with_prediction(state, params, steps_per_minute=1):
     """ calculates the profit & loss for a liquidator that can perfectly predict gas price n minutes ahead
-        function assumes that they cannot predict ETH prices """
-    n = int(params['gas_prediction_ability'] * 60)  # n minutes
-    gas_prices = np.array(df['three_min_median'])  # use 3 min median gas price for accurate execution prices
-    output_n_rows = gas_prices.shape[0] - n + 3
-
-    l_mask = np.asarray(np.array(df['n_liquidated']) > 0)  # for selecting rows in full df
+        function assumes that they cannot predict ETH prices
+        steps_per_minute sets the resolution of the state's rows, e.g. 60 for per-second gas data """
+    n = int(params['gas_prediction_ability'] * 60 * steps_per_minute)  # n rows
+    window_size = n - 2 * steps_per_minute
+    gas_prices = state['three_min_median']  # use 3 min median gas price for accurate execution prices
+    output_n_rows = max(gas_prices.shape[0] - window_size + 1, 0)  # no row has a full window in a short state
+
+    l_mask = np.asarray(state['n_liquidated'] > 0)  # for selecting rows in full state
     l_mask_subset = l_mask[:output_n_rows]  # excludes rows at end of dataset without full window of data
 
-    # gas indices create windows of size n - 2 by referencing indices in gas_prices
-    gas_indices = np.arange(n - 2)[None, :] + np.arange(output_n_rows)[l_mask_subset][:, None]
-    n_rows = gas_indices.shape[0]  # n rows in subspace of only rows with liquidations
+    liquidation_sizes = state['liquidation_size_sum'][:output_n_rows][l_mask_subset]  # every stream in the row
+    posted_margin = stream_rate_to_margin(liquidation_sizes, params['upfront_hours'])
+    stream_per_step = month_to_minute(liquidation_sizes) / steps_per_minute
+    eth_price = state['price'][:output_n_rows][l_mask_subset]
 
-    posted_margin = stream_rate_to_margin(np.array(df['avg_liquidation_size'])[:output_n_rows][l_mask_subset], params['upfront_hours'])
-    stream_per_minute = month_to_minute(np.array(df['avg_liquidation_size'])[:output_n_rows][l_mask_subset])
-    eth_price = np.array(df['price'])[:output_n_rows][l_mask_subset]
+    best_gas_prices, best_profits = find_best_executions(gas_prices, np.flatnonzero(l_mask_subset), posted_margin,
+                                                         stream_per_step, eth_price, window_size,
+                                                         params['refund_rate'],
+                                                         tx_counts=state['n_liquidated'][:output_n_rows][l_mask_subset])
 
-    remaining_margin = posted_margin[:, None] - np.arange(n - 2)[None, :] * stream_per_minute[:, None]
-    tx_costs = LIQUIDATION_GAS * gwei_to_eth(gas_prices[gas_indices]) * eth_price[:n_rows, None] * (
-            1 - params['refund_rate'])  # for every possible time per liquidation
+    state.n_rows = output_n_rows  # cuts end of the state due to window size
 
-    liquidator_profits = remaining_margin - tx_costs
-    best_execution_indices = np.argmax(liquidator_profits, axis=1)
+    gas_prices_paid, liquidator_pl = state['gas_price_paid'], state['liquidator_pl']
+    gas_prices_paid[:] = 0
+    liquidator_pl[:] = 0
+    gas_prices_paid[l_mask_subset] = best_gas_prices
+    liquidator_pl[l_mask_subset] = best_profits
 
-    df = df[:output_n_rows]  # cuts end of df due to window size
+    return state
 
-    gas_prices_paid = np.zeros(output_n_rows)  # initialize for speed
-    liquidator_pl = np.zeros(output_n_rows)
 
-    gas_prices_paid[l_mask_subset] = gas_prices[gas_indices][np.arange(n_rows), best_execution_indices]
-    liquidator_pl[l_mask_subset] = liquidator_profits[np.arange(n_rows), best_execution_indices]
+@instrument('calculate_gas_tank_pl')
+def calculate_gas_tank_pl(state, params, gas_price_col=None):
+    """ calculates gas tank profit & loss in eth and usd, evaluated in place in the order of
+        gas_refunded_eth = LIQUIDATION_GAS * n_liquidated * gwei_to_eth(gas price) * refund_rate
+        gas_tank_eth_pl = n_opened * upfront_fee - gas_refunded_eth
+        gas_tank_usd_pl = gas_tank_eth_pl * price
+        the gas price column follows gas_prediction_ability unless gas_price_col is given """
+    if gas_price_col is None:
+        gas_price_col = 'median_gas_price' if params['gas_prediction_ability'] <= 3 / 60 else 'gas_price_paid'
+    gas_refunded_eth, gas_tank_eth_pl, gas_eth = (state['gas_refunded_eth'], state['gas_tank_eth_pl'],
+                                                  state.get_scratch(0))
 
-    df['gas_price_paid'] = gas_prices_paid
-    df['liquidator_pl'] = liquidator_pl
+    np.multiply(LIQUIDATION_GAS, state['n_liquidated'], out=gas_refunded_eth)
+    np.multiply(state[gas_price_col], 10 ** -9, out=gas_eth)
+    gas_refunded_eth *= gas_eth
+    gas_refunded_eth *= params['refund_rate']
 
-    return df
+    np.multiply(state['n_opened'], params['upfront_fee'], out=gas_tank_eth_pl)
+    gas_tank_eth_pl -= gas_refunded_eth
+    np.multiply(gas_tank_eth_pl, state['price'], out=state['gas_tank_usd_pl'])
 
+    return state
 
-def calculate_gas_tank_pl(df, params):
-    """ calculates gas tank profit & loss in eth and usd """
-    eth_price_col = 'median_gas_price' if params['gas_prediction_ability'] <= 3 / 60 else 'gas_price_paid'
 
-    df['gas_refunded_eth'] = LIQUIDATION_GAS * df['n_liquidated'] * gwei_to_eth(df[eth_price_col]) * params['refund_rate']
-    df['gas_tank_eth_pl'] = df['n_opened'] * params['upfront_fee'] - df['gas_refunded_eth']
-    df['gas_tank_usd_pl'] = df['gas_tank_eth_pl'] * df['price']
+@instrument('calculate_pl')
+def calculate_pl(state, params, steps_per_minute=1):
+    """ calculate profit & loss for liquidator and gas tank
+        can be called repeatedly on one simulated state, e.g. for several refund rates """
+    state.reset()
+    if params['gas_prediction_ability'] <= 3 / 60:  # minimum is 3 minutes for function to work
+        calculate_liquidator_pl(state, params)
+    else:
+        calculate_liquidator_pl_with_prediction(state, params, steps_per_minute)
 
-    return df
+    return calculate_gas_tank_pl(state, params)
 
 
-def calculate_pl(df, params):
-    """ calculate profit & loss for liquidator and gas tank """
-    if params['gas_prediction_ability'] <= 3 / 60:  # minimum is 3 minutes for function to work
-        df['liquidator_pl'] = calculate_liquidator_pl(df, params)
-    else:
-        df = calculate_liquidator_pl_with_prediction(df, params)
+####
+# common random numbers, design variants are evaluated on the same streams and shocks so their metric deltas are
+# not dominated by sampling noise
+####
 
-    return calculate_gas_tank_pl(df, params)
+def sample_common_draws(n_minutes, params):
+    """ draws every random number of a run up front, from the DRAW_PARAMS only
+        design params like upfront_fee, upfront_hours, refund_rate and gas_prediction_ability are applied afterwards by
+        simulate_streams_from_draws, so every variant sees the same arrival times, sizes and lifetime shocks """
+    stream_times = sample_new_stream_times(n_minutes, params)
+    n_streams = stream_times.shape[0]
+    gamma_k = params['distribution_inverse_skewness']
+    prob_self_closed, prob_liquidated, prob_closing_tx_is_liquidation = calculate_liquidation_probabilities(params)
+
+    return {'params': {p: params[p] for p in DRAW_PARAMS}, 'stream_times': stream_times,
+            'stream_sizes': rng.gamma(gamma_k, params['average_stream_size'] / gamma_k, n_streams),
+            'lifetimes': np.minimum(rng.exponential(1 / prob_liquidated, n_streams),
+                                    rng.exponential(1 / prob_self_closed, n_streams)),
+            'liquidation_mask': np.asarray(rng.uniform(0, 1, n_streams) < prob_closing_tx_is_liquidation)}
+
+
+def simulate_streams_from_draws(state, params, draws):
+    """ simulate_streams_and_liquidations on the draws of sample_common_draws
+        every stream is drawn whether or not it opens, so a fee change only changes which of the same streams open """
+    changed_params = [p for p in DRAW_PARAMS if params[p] != draws['params'][p]]
+    if changed_params:
+        raise ValueError('common draws were sampled for other values of {}'.format(changed_params))
+
+    state.reset()
+    times, sizes = draws['stream_times'], draws['stream_sizes']
+    opened_streams_mask = np.asarray(sizes > calculate_stream_costs(state['median_gas_price'][times],
+                                                                    state['price'][times], params))
+    new_stream_times, new_stream_sizes = times[opened_streams_mask], sizes[opened_streams_mask]
+
+    liquidation_times, liquidation_sizes, self_closed_times, self_closed_sizes = split_stream_ends(
+        new_stream_times + draws['lifetimes'][opened_streams_mask], new_stream_sizes,
+        draws['liquidation_mask'][opened_streams_mask], state.n_minutes)
+    bin_stream_events(state, new_stream_times, *convert_small_self_closes_to_liquidations(
+        liquidation_times, liquidation_sizes, self_closed_times, self_closed_sizes, state['median_gas_price'],
+        state['price'], params), new_stream_sizes)
+
+    return state
+
+
+def simulate_paired_variants(df, variants, n_sims=100, params=None):
+    """ evaluates every variant, a dict of param overrides such as {'upfront_fee': .04}, on the same draws in each of
+        n_sims simulations, base params are sampled per simulation unless given
+        returns one row of params and metrics per simulation and variant """
+    state = SimulationState(df)
+    results = []
+    for i in range(n_sims):
+        base_params = sample_params() if params is None else params
+        draws = sample_common_draws(state.n_minutes, base_params)
+        for j, variant in enumerate(variants):
+            variant_params = {**base_params, **variant}
+            state = calculate_pl(simulate_streams_from_draws(state, variant_params, draws), variant_params)
+            results.append({'sim_index': i, 'variant': j, **variant_params, **calculate_metrics(state, variant_params)})
+
+    return pd.DataFrame(results)
+
+
+def summarize_paired_deltas(results_df, metrics=PAIRED_METRICS, baseline=0):
+    """ mean metric delta of every variant against the baseline variant and the variance of the paired deltas
+        unpaired_se is the standard error independent draws would give, variance_reduction the ratio of the
+        variances """
+    baseline_df = results_df.loc[results_df['variant'] == baseline].set_index('sim_index')
+    rows = []
+    for variant, variant_df in results_df.loc[results_df['variant'] != baseline].groupby('variant'):
+        variant_df = variant_df.set_index('sim_index')
+        for metric in metrics:
+            deltas = (variant_df[metric] - baseline_df[metric]).dropna()
+            unpaired_var = variant_df[metric].var() + baseline_df[metric].var()
+            rows.append({'variant': variant, 'metric': metric, 'n_sims': deltas.shape[0], 'mean_delta': deltas.mean(),
+                         'delta_var': deltas.var(), 'paired_se': np.sqrt(deltas.var() / deltas.shape[0]),
+                         'unpaired_se': np.sqrt(unpaired_var / deltas.shape[0]),
+                         'variance_reduction': unpaired_var / deltas.var()})
+
+    return pd.DataFrame(rows)
 
 
 ####
@@ -277,23 +473,25 @@ def calculate_pl(df, params):
 
 
 def simulate_and_calculate_pl(df, params, deep_copy=False):
-    """ simulates liquidations data and calculates profit & loss over provided gas and eth price data """
-    if deep_copy:  # one line if else is significantly slower
-        df = df.copy(deep=True)
+    """ simulates liquidations data and calculates profit & loss over provided gas and eth price data
+        a SimulationState is simulated in place and returned, reuse one across runs to avoid allocations
+        a df is left unchanged and a new df of the results is returned, deep_copy is kept for old callers """
+    if isinstance(df, SimulationState):
+        return calculate_pl(simulate_streams_and_liquidations(df, params), params)
 
-    df = simulate_streams_and_liquidations(df, params)
+    state = calculate_pl(simulate_streams_and_liquidations(SimulationState(df), params), params)
 
-    return calculate_pl(df, params)
+    return state.to_df()
 
 
 def simulate_and_calculate_n_times(df, n_sims=1000):
-    """ simulates and calculates metrics for simulations """
+    """ simulates and calculates metrics for simulations, reusing one state for every run """
+    state = SimulationState(df)
     output = np.zeros((n_sims, 20))
     for i in range(n_sims):
-        local_df = df.copy(deep=True)
         params = sample_params()
-        local_df = simulate_and_calculate_pl(local_df, params)
-        metrics = calculate_metrics(local_df, params)
+        state = simulate_and_calculate_pl(state, params)
+        metrics = calculate_metrics(state, params)
         metrics_dict = {**params, **metrics}
         output[i, :] = list(metrics_dict.values())
 
@@ -5,6 +5,7 @@
 import pandas as pd
 import numpy as np
 from numpy.random import default_rng
+from scipy.stats import qmc
 
 rng = default_rng()
 
@@ -29,10 +30,14 @@ UNIFORM_PARAM_RANGES = {
     'distribution_inverse_skewness': [.8, 5]  # sets the gamma_k variable, lowest value most skew
 }
 
+SAMPLED_PARAMS = [*LOGUNIFORM_PARAM_RANGES, *UNIFORM_PARAM_RANGES]  # params drawn within a FEES x HOURS cell
+PARAM_NAMES = ['upfront_fee', 'upfront_hours', *SAMPLED_PARAMS]
+QMC_METHODS = ['sobol', 'lhs']
+
 
 def sample_params():
     """ samples param space randomly """
-    core_params = {'upfront_fee': np.random.choice(FEES), 'upfront_hours': np.random.choice(HOURS)}
+    core_params = {'upfront_fee': rng.choice(FEES), 'upfront_hours': rng.choice(HOURS)}
     loguniform_params = {p: np.exp(rng.uniform(np.log(LOGUNIFORM_PARAM_RANGES[p][0] + .0001),
                                                np.log(LOGUNIFORM_PARAM_RANGES[p][1] + .0001))) for p in
                          LOGUNIFORM_PARAM_RANGES}
@@ -41,3 +46,69 @@ def sample_params():
                                      UNIFORM_PARAM_RANGES[p][1]) for p in UNIFORM_PARAM_RANGES}
 
     return {**core_params, **loguniform_params, **uniform_params}
+
+
+def limit_range(param_range, bound=None):
+    """ the part of a [low, high] param range inside bound, a (low, high) pair, or the whole range without one """
+    if bound is None:
+        return param_range
+
+    return [max(param_range[0], bound[0]), min(param_range[1], bound[1])]
+
+
+def limit_choices(choices, bound=None):
+    """ the choices inside bound, a (low, high) pair, or every choice without one """
+    if bound is None:
+        return choices
+
+    return choices[(choices >= bound[0]) & (choices <= bound[1])]
+
+
+def sample_params_batch(n, bounds=None):
+    """ samples n param sets at once as a structured array with one float field per param, in sample_params order
+        bounds optionally maps params to (low, high) limits within their ranges, e.g. the ranges training rows cover """
+    bounds = bounds or {}
+    params = np.zeros(n, dtype=[(p, float) for p in PARAM_NAMES])
+    params['upfront_fee'] = rng.choice(limit_choices(FEES, bounds.get('upfront_fee')), n)
+    params['upfront_hours'] = rng.choice(limit_choices(HOURS, bounds.get('upfront_hours')), n)
+    for p in LOGUNIFORM_PARAM_RANGES:
+        low, high = limit_range(LOGUNIFORM_PARAM_RANGES[p], bounds.get(p))
+        params[p] = np.exp(rng.uniform(np.log(low + .0001), np.log(high + .0001), n))
+    for p in UNIFORM_PARAM_RANGES:
+        low, high = limit_range(UNIFORM_PARAM_RANGES[p], bounds.get(p))
+        params[p] = rng.uniform(low, high, n)
+
+    return params
+
+
+def create_qmc_sampler(method='sobol', seed=None, n_dims=len(SAMPLED_PARAMS)):
+    """ low-discrepancy sampler over the unit hypercube of n_dims params, by default every loguniform and uniform one
+        sobol is scrambled, so its points are still random, draw them in powers of 2 to keep the sequence balanced """
+    if method == 'sobol':
+        return qmc.Sobol(n_dims, scramble=True, seed=seed)
+    if method == 'lhs':
+        return qmc.LatinHypercube(n_dims, seed=seed)
+
+    raise ValueError('unknown qmc method {}, expected one of {}'.format(method, QMC_METHODS))
+
+
+def scale_unit_params(unit_samples, upfront_fee, upfront_hours, sampled_params=SAMPLED_PARAMS):
+    """ maps rows of unit hypercube samples onto the ranges of sampled_params, one column each, for one FEES x HOURS
+        cell, uses the same log and linear transforms as sample_params_batch, params not sampled are left at 0 """
+    params = np.zeros(unit_samples.shape[0], dtype=[(p, float) for p in PARAM_NAMES])
+    params['upfront_fee'] = upfront_fee
+    params['upfront_hours'] = upfront_hours
+    for i, p in enumerate(sampled_params):
+        if p in LOGUNIFORM_PARAM_RANGES:
+            low, high = np.log(LOGUNIFORM_PARAM_RANGES[p][0] + .0001), np.log(LOGUNIFORM_PARAM_RANGES[p][1] + .0001)
+            params[p] = np.exp(low + unit_samples[:, i] * (high - low))
+        else:
+            low, high = UNIFORM_PARAM_RANGES[p]
+            params[p] = low + unit_samples[:, i] * (high - low)
+
+    return params
+
+
+def sample_qmc_params_batch(sampler, n, upfront_fee, upfront_hours, sampled_params=SAMPLED_PARAMS):
+    """ draws the next n points of a cell's create_qmc_sampler sampler as a sample_params_batch structured array """
+    return scale_unit_params(sampler.random(n), upfront_fee, upfront_hours, sampled_params)
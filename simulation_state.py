@@ -0,0 +1,67 @@
+####
+# struct-of-arrays state of a simulation run, the pandas-free core shared by simulation_functions and
+# metrics_extraction
+# price columns are views of the input data, simulation columns are float buffers allocated once and overwritten by
+# every run, so a state can be reused across a whole sweep
+####
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrument
+
+PRICE_COLUMNS = ['median_gas_price', 'three_min_median', 'price']
+SIMULATION_COLUMNS = ['n_opened', 'n_liquidated', 'n_self_closed', 'avg_liquidation_size', 'avg_self_closed_size',
+                      'liquidation_size_sum', 'self_closed_size_sum', 'n_open', 'open_stream_size',
+                      'gas_price_paid', 'liquidator_pl', 'gas_refunded_eth', 'gas_tank_eth_pl', 'gas_tank_usd_pl']
+N_SCRATCH_BUFFERS = 3  # temporaries for the P&L and metrics calculations
+
+
+class SimulationState:
+    """ per-minute price and simulation columns of one run
+        state['column'] reads like a df column, cut to the n_rows with valid data, e.g. after a gas prediction window
+        prices can be a df or a dict of arrays, simulation columns it already holds are copied in """
+
+    def __init__(self, prices):
+        self.capacity = np.asarray(prices['price']).shape[0]  # n minutes the buffers hold
+        self.load_prices(prices)
+
+        self.buffers = {column: np.zeros(self.n_minutes) for column in SIMULATION_COLUMNS}
+        for column in SIMULATION_COLUMNS:
+            if column in prices:
+                self.buffers[column][:] = prices[column]
+        self.scratch = [np.empty(self.n_minutes) for i in range(N_SCRATCH_BUFFERS)]
+
+    def __getitem__(self, column):
+        values = self.prices[column] if column in self.prices else self.buffers[column]
+
+        return values[:self.n_rows]
+
+    def __contains__(self, column):
+        return column in self.prices or column in self.buffers
+
+    def load_prices(self, prices):
+        """ points the state at new price data, e.g. the next chunk of a long history, without reallocating
+            the buffers keep their size, so the new data can't have more minutes than the first """
+        self.prices = {column: np.asarray(prices[column], dtype=float) for column in PRICE_COLUMNS}
+        self.time = np.asarray(prices['time']) if 'time' in prices else None
+        self.n_minutes = self.prices['price'].shape[0]
+        self.n_rows = self.n_minutes
+        if self.n_minutes > self.capacity:
+            raise ValueError('{} minutes of prices exceed the state\'s {} minute buffers'.format(
+                self.n_minutes, self.capacity))
+
+    def reset(self):
+        """ makes every minute valid again before a new run """
+        self.n_rows = self.n_minutes
+
+    def get_scratch(self, i):
+        return self.scratch[i][:self.n_rows]
+
+    @instrument('to_df')
+    def to_df(self, columns=None):
+        """ builds a df of the valid rows, only needed for plotting and inspection """
+        columns = columns or PRICE_COLUMNS + SIMULATION_COLUMNS
+        data = {'time': self.time[:self.n_rows]} if self.time is not None else {}
+
+        return pd.DataFrame({**data, **{column: self[column].copy() for column in columns}})
@@ -0,0 +1,151 @@
+####
+# memoized simulation stages for grid sweeps, each stage's event arrays are cached under a seed plus the params of that
+# stage and every stage before it, so runs that only change downstream params reuse the upstream arrays
+# every stage draws from its own rng derived from the seed, so a cached stage gives the same output as a recomputed one
+####
+
+import itertools
+from collections import OrderedDict
+
+import pandas as pd
+from numpy.random import SeedSequence, default_rng
+
+import simulation_functions
+from simulation_functions import (sample_new_stream_times, sample_stream_sizes, simulate_naive_liquidation_times,
+                                  convert_small_self_closes_to_liquidations, bin_stream_events, calculate_pl)
+from metrics_extraction import calculate_metrics
+from simulation_state import SimulationState
+
+STAGE_CACHE_MAX_BYTES = 2 ** 30
+
+# (stage, params it depends on) in pipeline order, P&L params like refund_rate and gas_prediction_ability come after
+STAGES = [
+    ('arrivals', ['monthly_opened_streams']),
+    ('sizes', ['distribution_inverse_skewness', 'average_stream_size', 'upfront_fee', 'lowest_stream_cost_ratio']),
+    ('ends', ['average_stream_lifetime', 'percent_accidently_liquidated_per_month']),
+    ('conversions', ['min_self_liquidation_savings', 'upfront_hours']),
+]
+
+
+####
+# lru cache
+####
+
+def create_stage_cache(max_bytes=STAGE_CACHE_MAX_BYTES):
+    """ lru cache of stage outputs, bounded by the bytes of the cached arrays """
+    return {'entries': OrderedDict(), 'n_bytes': 0, 'max_bytes': max_bytes, 'hits': 0, 'misses': 0}
+
+
+def get_n_bytes(arrays):
+    return sum(array.nbytes for array in arrays)
+
+
+def get_cached(cache, key, compute):
+    """ returns the cached arrays for key, or computes, caches and returns them
+        cached arrays are read-only since every later run shares them """
+    if key in cache['entries']:
+        cache['hits'] += 1
+        cache['entries'].move_to_end(key)
+        return cache['entries'][key]
+
+    cache['misses'] += 1
+    arrays = compute()
+    for array in arrays:
+        array.flags.writeable = False
+
+    cache['entries'][key] = arrays
+    cache['n_bytes'] += get_n_bytes(arrays)
+    while cache['n_bytes'] > cache['max_bytes'] and len(cache['entries']) > 1:
+        cache['n_bytes'] -= get_n_bytes(cache['entries'].popitem(last=False)[1])
+
+    return arrays
+
+
+def clear_stage_cache(cache):
+    cache['entries'].clear()
+    cache['n_bytes'] = 0
+
+
+stage_cache = create_stage_cache()
+
+
+####
+# stages
+####
+
+def get_stage_keys(params, seed, n_minutes):
+    """ one key per stage of the seed, n minutes and the params of the stage and every stage before it """
+    key = (seed, n_minutes)
+    keys = []
+    for stage, stage_params in STAGES:
+        key = key + tuple(float(params[p]) for p in stage_params)
+        keys.append((stage,) + key)
+
+    return keys
+
+
+def run_stage(seed, stage_index, function, *args):
+    """ runs a stage function with simulation_functions' rng set to the stage's own rng for this seed """
+    module_rng = simulation_functions.rng
+    simulation_functions.rng = default_rng(SeedSequence(seed, spawn_key=(stage_index,)))
+    try:
+        return function(*args)
+    finally:
+        simulation_functions.rng = module_rng
+
+
+def simulate_events_cached(state, params, seed, cache=stage_cache):
+    """ returns the (new stream times, liquidation times, self-closed times, liquidation sizes, self-closed sizes,
+        new stream sizes) of simulate_streams for a seed, computing only the stages missing from the cache """
+    gas_price, eth_price, n_minutes = state['median_gas_price'], state['price'], state.n_minutes
+    arrivals_key, sizes_key, ends_key, conversions_key = get_stage_keys(params, seed, n_minutes)
+
+    def compute_arrivals():
+        return (run_stage(seed, 0, sample_new_stream_times, n_minutes, params),)
+
+    def compute_sizes():
+        times, = get_cached(cache, arrivals_key, compute_arrivals)
+        return run_stage(seed, 1, sample_stream_sizes, times, gas_price[times], eth_price[times], params)
+
+    def compute_ends():
+        times, sizes = get_cached(cache, sizes_key, compute_sizes)
+        return run_stage(seed, 2, simulate_naive_liquidation_times, times, sizes, n_minutes, params)
+
+    def compute_conversions():
+        return convert_small_self_closes_to_liquidations(*get_cached(cache, ends_key, compute_ends), gas_price,
+                                                         eth_price, params)
+
+    liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes = get_cached(
+        cache, conversions_key, compute_conversions)
+    new_stream_times, new_stream_sizes = get_cached(cache, sizes_key, compute_sizes)
+
+    return (new_stream_times, liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes,
+            new_stream_sizes)
+
+
+####
+# aggregate functions
+####
+
+def simulate_and_calculate_pl_cached(state, params, seed, cache=stage_cache):
+    """ simulate_and_calculate_pl on a SimulationState, reproducible for a seed and reusing cached stages
+        the cache is only valid for one price dataset, clear it before switching """
+    state.reset()
+    bin_stream_events(state, *simulate_events_cached(state, params, seed, cache))
+
+    return calculate_pl(state, params)
+
+
+def simulate_grid(df, params, grid, seeds, cache=stage_cache):
+    """ calculates metrics for every seed and every combination of the param values in grid, e.g.
+        {'refund_rate': np.linspace(0, 1, 11), 'upfront_hours': HOURS}, with the other params fixed
+        seeds are the outer loop, so runs sharing a seed reuse every stage upstream of the grid params """
+    state = SimulationState(df)
+    results = []
+    for seed in seeds:
+        for values in itertools.product(*grid.values()):
+            run_params = {**params, **dict(zip(grid, values))}
+            state = simulate_and_calculate_pl_cached(state, run_params, seed, cache)
+            results.append({'seed': seed, **run_params, **calculate_metrics(state, run_params)})
+
+    return pd.DataFrame(results)
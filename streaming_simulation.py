@@ -0,0 +1,135 @@
+#########
+# These functions simulate one run over a long price history in bounded chunks of rows, e.g. years of per-second gas
+# data read from a memory-mapped cache
+# streams still open at the end of a chunk are carried into the next one and the metrics are updated online, so memory
+# depends on the chunk size and the number of open streams but not on the history length
+#########
+
+import numpy as np
+from numpy.random import default_rng
+
+from simulation_functions import (minute_to_month, calculate_liquidation_probabilities, sample_stream_sizes,
+                                  convert_small_self_closes_to_liquidations, bin_stream_events, calculate_pl)
+from metrics_extraction import create_running_metrics, update_running_metrics, calculate_running_metrics
+from simulation_state import PRICE_COLUMNS, SimulationState
+
+rng = default_rng()
+
+CHUNK_SIZE = 2 ** 18  # rows per chunk, about 6 months of minutes
+
+
+####
+# open streams
+####
+
+def create_open_streams():
+    """ end rows, sizes and end types of streams opened in earlier chunks that haven't ended yet """
+    return {'end_times': np.zeros(0), 'sizes': np.zeros(0), 'liquidation_mask': np.zeros(0, dtype=bool)}
+
+
+def get_n_new_streams(start, end, params, steps_per_minute=1):
+    """ n streams opened in rows [start, end), chunks together open as many streams as sample_new_stream_times """
+    return int(params['monthly_opened_streams'] * minute_to_month(end / steps_per_minute) // 1 -
+               params['monthly_opened_streams'] * minute_to_month(start / steps_per_minute) // 1)
+
+
+def sample_stream_ends(times, sizes, params, steps_per_minute=1):
+    """ simulate_naive_liquidation_times without the cut at the end of the data, returns end rows and end types """
+    n_samples = times.shape[0]
+    prob_self_closed, prob_liquidated, prob_closing_tx_is_liquidation = calculate_liquidation_probabilities(params)
+
+    end_times = times + steps_per_minute * np.minimum(rng.exponential(1 / prob_liquidated, n_samples),
+                                                      rng.exponential(1 / prob_self_closed, n_samples))
+
+    return end_times, np.asarray(rng.uniform(0, 1, n_samples) < prob_closing_tx_is_liquidation)
+
+
+def open_streams_in_chunk(open_streams, start, chunk, n_body_rows, params, steps_per_minute=1):
+    """ samples the streams opened in the chunk's first n_body_rows and adds them to open_streams
+        returns their rows within the chunk and sizes """
+    n_new_streams = get_n_new_streams(start, start + n_body_rows, params, steps_per_minute)
+    times = rng.uniform(0, n_body_rows, n_new_streams).astype(int)  # rows within the chunk
+    times, sizes = sample_stream_sizes(times, chunk['median_gas_price'][times], chunk['price'][times], params)
+    end_times, liquidation_mask = sample_stream_ends(start + times, sizes, params, steps_per_minute)
+
+    open_streams['end_times'] = np.concatenate([open_streams['end_times'], end_times])
+    open_streams['sizes'] = np.concatenate([open_streams['sizes'], sizes])
+    open_streams['liquidation_mask'] = np.concatenate([open_streams['liquidation_mask'], liquidation_mask])
+
+    return times, sizes
+
+
+def close_streams_in_chunk(open_streams, start, end):
+    """ removes the streams ending before row end from open_streams
+        returns their liquidation and self-close rows within the chunk and their sizes """
+    ended_mask = np.asarray(open_streams['end_times'] < end)
+    end_times = open_streams['end_times'][ended_mask].astype(int) - start
+    sizes, liquidation_mask = open_streams['sizes'][ended_mask], open_streams['liquidation_mask'][ended_mask]
+    for key in open_streams:
+        open_streams[key] = open_streams[key][~ended_mask]
+
+    return end_times[liquidation_mask], sizes[liquidation_mask], end_times[~liquidation_mask], sizes[~liquidation_mask]
+
+
+####
+# chunks
+####
+
+def get_prediction_overlap(params, steps_per_minute=1):
+    """ rows of lookahead a chunk needs past its end so calculate_liquidator_pl_with_prediction keeps every row """
+    if params['gas_prediction_ability'] <= 3 / 60:
+        return 0
+
+    return int(params['gas_prediction_ability'] * 60 * steps_per_minute) - 2 * steps_per_minute - 1
+
+
+def iterate_price_chunks(prices, chunk_size=CHUNK_SIZE, overlap=0):
+    """ yields the start row and a dict of price column views for every chunk_size rows, plus overlap rows past the
+        chunk that only serve as lookahead
+        memory-mapped columns, e.g. from load_price_data, are only read as each chunk is used """
+    columns = {column: np.asarray(prices[column]) for column in PRICE_COLUMNS}
+    n_rows = columns['price'].shape[0]
+    for start in range(0, n_rows, chunk_size):
+        yield start, {column: values[start:start + chunk_size + overlap] for column, values in columns.items()}
+
+
+def simulate_chunk(state, open_streams, start, chunk, n_body_rows, params, steps_per_minute=1):
+    """ simulates one chunk into the state's buffers, like simulate_streams_and_liquidations and calculate_pl
+        for a whole history, only the chunk's first n_body_rows hold events """
+    state.load_prices(chunk)
+    n_open_start, open_size_start = open_streams['sizes'].shape[0], np.sum(open_streams['sizes'])
+    new_stream_times, new_stream_sizes = open_streams_in_chunk(open_streams, start, chunk, n_body_rows, params,
+                                                               steps_per_minute)
+    ended_streams = close_streams_in_chunk(open_streams, start, start + n_body_rows)
+    liquidation_times, self_closed_times, liquidation_sizes, self_closed_sizes = (
+        convert_small_self_closes_to_liquidations(*ended_streams, state['median_gas_price'], state['price'], params))
+
+    bin_stream_events(state, new_stream_times, liquidation_times, self_closed_times, liquidation_sizes,
+                      self_closed_sizes, new_stream_sizes, n_open_start, open_size_start)
+
+    return calculate_pl(state, params, steps_per_minute)
+
+
+####
+# aggregate function
+####
+
+def simulate_and_calculate_metrics_chunked(prices, params, chunk_size=CHUNK_SIZE, steps_per_minute=1):
+    """ simulates one run chunk by chunk and returns the calculate_metrics dict
+        prices is a df or dict of price columns with one row per 1 / steps_per_minute minutes
+        matches calculate_metrics on the same events up to rounding of the mean price
+        the last overlap rows never have a full prediction window, a chunk starting in them holds no valid rows """
+    overlap = get_prediction_overlap(params, steps_per_minute)
+    n_rows = np.asarray(prices['price']).shape[0]
+    open_streams, running, state = create_open_streams(), create_running_metrics(), None
+
+    for start, chunk in iterate_price_chunks(prices, chunk_size, overlap):
+        if start >= n_rows - overlap:  # calculate_pl would cut every row
+            break
+        if state is None:
+            state = SimulationState(chunk)  # the first chunk is the largest, so its buffers fit every chunk
+        n_body_rows = min(chunk_size, n_rows - start)
+        update_running_metrics(running, simulate_chunk(state, open_streams, start, chunk, n_body_rows, params,
+                                                       steps_per_minute))
+
+    return calculate_running_metrics(running)
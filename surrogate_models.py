@@ -0,0 +1,184 @@
+####
+# surrogate models fit on accumulated sweep results, they map sampled params to calculate_metrics outputs so design
+# questions can be answered from predictions instead of new sweeps
+# each surrogate is a random forest, the spread of its trees' predictions marks where it is least certain
+####
+
+import glob
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+
+from simulation_parameters import PARAM_NAMES, sample_params_batch
+from simulation_functions import simulate_and_calculate_pl
+from metrics_extraction import calculate_metrics
+from simulation_state import SimulationState
+from results_store import COMMIT_NAME, read_results
+from sweep_manifest import MANIFEST_NAME, read_sweep_results
+
+SURROGATE_METRICS = ['total_profit', 'liquidator_md_percent', 'liquidator_percent_of_profit', 'percent_self_closed']
+N_ESTIMATORS = 100
+MIN_SAMPLES_LEAF = 5
+VALIDATION_SIZE = .2
+N_CANDIDATES = 10000  # random param sets scored per active learning or optimization query
+N_BACKGROUND = 200  # training rows the free params of a grid query are averaged over
+
+
+####
+# training data
+####
+
+def load_training_data(path):
+    """ reads sweep results from a results store, a resumable sweep directory or a directory of run.py csvs """
+    if os.path.exists(os.path.join(path, COMMIT_NAME)):
+        return read_results(path)
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        return read_sweep_results(path)
+
+    files = glob.glob(os.path.join(path, '**', '*.csv'), recursive=True)
+    return pd.concat([pd.read_csv(f, index_col=0) for f in files]).reset_index(drop=True)
+
+
+def get_features(df, params=PARAM_NAMES):
+    return np.array(df[params], dtype=float)
+
+
+####
+# fitting
+####
+
+def fit_surrogate(results_df, metric, params=PARAM_NAMES, validation_size=VALIDATION_SIZE, seed=None):
+    """ fits a surrogate for one metric, rows where the metric is nan or infinite are dropped
+        returns a dict of the model refit on every row, its error on a held out validation split and the (low, high)
+        range of each param in the training rows """
+    results_df = results_df.loc[np.isfinite(np.array(results_df[metric], dtype=float))]
+    features, targets = get_features(results_df, params), np.array(results_df[metric], dtype=float)
+
+    train_features, validation_features, train_targets, validation_targets = train_test_split(
+        features, targets, test_size=validation_size, random_state=seed)
+    model = RandomForestRegressor(N_ESTIMATORS, min_samples_leaf=MIN_SAMPLES_LEAF, n_jobs=-1, random_state=seed)
+    predictions = model.fit(train_features, train_targets).predict(validation_features)
+    validation = {'n_rows': targets.shape[0],
+                  'r2': r2_score(validation_targets, predictions),
+                  'mae': mean_absolute_error(validation_targets, predictions),
+                  'rmse': np.sqrt(mean_squared_error(validation_targets, predictions))}
+
+    return {'metric': metric, 'params': params, 'validation': validation, 'model': model.fit(features, targets),
+            'bounds': {p: (np.min(features[:, i]), np.max(features[:, i])) for i, p in enumerate(params)}}
+
+
+def fit_surrogates(results_df, metrics=SURROGATE_METRICS, params=PARAM_NAMES, seed=None):
+    """ fits one surrogate per metric, returns a metric -> surrogate dict """
+    return {metric: fit_surrogate(results_df, metric, params, seed=seed) for metric in metrics}
+
+
+def get_validation_report(surrogates):
+    """ returns the validation error of every surrogate as a df """
+    return pd.DataFrame([{'metric': metric, **surrogate['validation']} for metric, surrogate in surrogates.items()])
+
+
+####
+# queries
+####
+
+def predict(surrogate, params_df, return_std=False):
+    """ predicts the surrogate's metric for a df or structured array of param sets
+        return_std adds the std of the trees' predictions, large where the surrogate is uncertain """
+    features = get_features(params_df, surrogate['params'])
+    if not return_std:
+        return surrogate['model'].predict(features)
+
+    tree_predictions = np.array([tree.predict(features) for tree in surrogate['model'].estimators_])
+    return np.mean(tree_predictions, axis=0), np.std(tree_predictions, axis=0)
+
+
+def get_bounds(surrogates):
+    """ the widest (low, high) range of each param over the surrogates' training rows """
+    bounds = {}
+    for surrogate in surrogates.values():
+        for p, (low, high) in surrogate['bounds'].items():
+            bounds[p] = (min(low, bounds[p][0]), max(high, bounds[p][1])) if p in bounds else (low, high)
+
+    return bounds
+
+
+def sample_candidates(n_candidates=N_CANDIDATES, fixed=None, bounds=None):
+    """ samples candidate param sets as a df, with the params in fixed held at the given values
+        bounds limits params to (low, high) ranges, e.g. a surrogate's bounds, so it isn't queried where it
+        extrapolates """
+    candidates = pd.DataFrame(sample_params_batch(n_candidates, bounds))
+    for p, value in (fixed or {}).items():
+        candidates[p] = value
+
+    return candidates
+
+
+def query_grid(surrogate, grid, background_df, n_background=N_BACKGROUND, seed=None):
+    """ predicts the metric over the cartesian product of the param values in grid, e.g. {'upfront_fee': FEES}
+        params not in grid are averaged over n_background rows of background_df, usually the training data """
+    background = background_df.sample(min(n_background, background_df.shape[0]), random_state=seed)
+    points = pd.DataFrame(list(itertools.product(*grid.values())), columns=list(grid))
+
+    rows = background[surrogate['params']].iloc[np.repeat(np.arange(background.shape[0]), points.shape[0])]
+    rows = rows.reset_index(drop=True)
+    rows[list(grid)] = pd.concat([points] * background.shape[0], ignore_index=True)
+
+    points[surrogate['metric']] = predict(surrogate, rows).reshape(background.shape[0], points.shape[0]).mean(axis=0)
+    return points
+
+
+def optimize_params(surrogate, fixed=None, target=None, maximize=True, n_candidates=N_CANDIDATES, n_best=10):
+    """ returns the n_best of n_candidates sampled param sets with the params in fixed held constant
+        ranked by closeness of the prediction to target if it is given, else by the largest or smallest prediction
+        candidates stay within the training rows' param ranges, the {metric}_std column is the trees' spread """
+    candidates = sample_candidates(n_candidates, fixed, surrogate['bounds'])
+    predictions, stds = predict(surrogate, candidates, return_std=True)
+    candidates[surrogate['metric']], candidates[surrogate['metric'] + '_std'] = predictions, stds
+    order = (np.argsort(np.abs(predictions - target)) if target is not None else
+             np.argsort(-predictions if maximize else predictions))
+
+    return candidates.iloc[order[:n_best]].reset_index(drop=True)
+
+
+####
+# active learning
+####
+
+def propose_points(surrogates, n_points, n_candidates=N_CANDIDATES, fixed=None):
+    """ proposes the n_points candidate param sets within the training rows' param ranges where the surrogates are
+        least certain, each metric's tree std is scaled by its validation rmse so metrics of different scale count
+        alike """
+    candidates = sample_candidates(n_candidates, fixed, get_bounds(surrogates))
+    uncertainty = np.zeros(n_candidates)
+    for surrogate in surrogates.values():
+        uncertainty += predict(surrogate, candidates, return_std=True)[1] / surrogate['validation']['rmse']
+
+    return candidates.iloc[np.argsort(-uncertainty)[:n_points]].reset_index(drop=True)
+
+
+def simulate_points(df, points):
+    """ runs simulate_and_calculate_pl and calculate_metrics for each proposed param set
+        returns rows in the sweep results format to add to the training data """
+    state = SimulationState(df)
+    results = []
+    for params in points[PARAM_NAMES].to_dict('records'):
+        state = simulate_and_calculate_pl(state, params)
+        results.append({**params, **calculate_metrics(state, params)})
+
+    return pd.DataFrame(results)
+
+
+def run_active_learning(df, results_df, n_rounds, n_points, metrics=SURROGATE_METRICS, seed=None):
+    """ alternates fitting surrogates and simulating the points they are least certain about
+        returns the refit surrogates and the training data grown by n_rounds * n_points rows """
+    for i in range(n_rounds):
+        surrogates = fit_surrogates(results_df, metrics, seed=seed)
+        results_df = pd.concat([results_df, simulate_points(df, propose_points(surrogates, n_points))],
+                               ignore_index=True)
+
+    return fit_surrogates(results_df, metrics, seed=seed), results_df
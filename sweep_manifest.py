@@ -0,0 +1,118 @@
+####
+# functions for resumable sweeps, a manifest fixes the root seed and the shard layout and finished shards are
+# committed to a results store in a shared sweep directory, so a restarted machine only runs the shards still missing
+####
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.random import SeedSequence, default_rng
+
+from results_store import append_results, get_completed_tags, read_results
+
+MANIFEST_NAME = 'manifest.json'
+STORE_PREFIX = 'store_'
+SIMULATION_KEY = 0  # spawn key namespaces so simulation and shard seeds never collide
+SHARD_KEY = 1
+
+
+####
+# seeds
+####
+
+def get_simulation_rng(seed, sim_index):
+    """ rng for one simulation index, derived from the root seed without spawning every earlier child """
+    return default_rng(SeedSequence(seed, spawn_key=(SIMULATION_KEY, sim_index)))
+
+
+def get_shard_rng(seed, shard_index):
+    """ rng for a whole shard, used when a shard runs as one batched pass """
+    return default_rng(SeedSequence(seed, spawn_key=(SHARD_KEY, shard_index)))
+
+
+####
+# manifest
+####
+
+def get_manifest_path(sweep_dir):
+    return os.path.join(sweep_dir, MANIFEST_NAME)
+
+
+def load_manifest(sweep_dir):
+    """ returns the sweep's manifest or None for a new sweep directory """
+    if not os.path.exists(get_manifest_path(sweep_dir)):
+        return None
+
+    with open(get_manifest_path(sweep_dir)) as f:
+        return json.load(f)
+
+
+def create_manifest(sweep_dir, n_sims, shard_size, batch=False, seed=None):
+    """ writes a new manifest, drawing a root seed from fresh entropy unless one is given
+        the complete file is hard linked into place, which fails if a manifest exists, so of machines starting the
+        same sweep at once only the first writes one, returns None if another machine's manifest won """
+    manifest = {'seed': SeedSequence(seed).entropy, 'n_sims': n_sims, 'shard_size': shard_size, 'batch': batch}
+    os.makedirs(sweep_dir, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(get_manifest_path(sweep_dir), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    try:
+        os.link(tmp_path, get_manifest_path(sweep_dir))
+    except FileExistsError:
+        return None
+    finally:
+        os.remove(tmp_path)
+
+    return manifest
+
+
+def load_or_create_manifest(sweep_dir, n_sims, shard_size, batch=False, seed=None):
+    """ an existing manifest always wins, so a resumed sweep, or a machine that loses the race to create the
+        manifest, keeps the sweep's seed and shard layout """
+    return (load_manifest(sweep_dir) or create_manifest(sweep_dir, n_sims, shard_size, batch, seed) or
+            load_manifest(sweep_dir))
+
+
+####
+# shards
+####
+
+def get_store_dir(sweep_dir, machine_index=0):
+    """ each machine commits to its own store, since a store has a single writer """
+    return os.path.join(sweep_dir, '{}{:03d}'.format(STORE_PREFIX, machine_index))
+
+
+def get_store_dirs(sweep_dir):
+    return sorted(glob.glob(os.path.join(sweep_dir, STORE_PREFIX + '*')))
+
+
+def get_shards(manifest):
+    """ returns (shard index, first simulation index, n simulations) for every shard of the sweep """
+    starts = np.arange(0, manifest['n_sims'], manifest['shard_size'])
+
+    return [(i, int(start), int(min(manifest['shard_size'], manifest['n_sims'] - start)))
+            for i, start in enumerate(starts)]
+
+
+def get_pending_shards(sweep_dir, manifest, machine_index=0, n_machines=1):
+    """ shards not committed to any machine's store, split round-robin so machines sharing sweep_dir never run the
+        same one """
+    completed = set().union(*[get_completed_tags(store_dir) for store_dir in get_store_dirs(sweep_dir)])
+
+    return [shard for shard in get_shards(manifest) if shard[0] % n_machines == machine_index and
+            shard[0] not in completed]
+
+
+def write_shard(sweep_dir, shard_index, result_df, machine_index=0):
+    """ commits a finished shard's rows together with its index, so a shard is only ever stored complete """
+    append_results(get_store_dir(sweep_dir, machine_index), result_df, tag=shard_index)
+
+
+def read_sweep_results(sweep_dir, columns=None):
+    """ returns the committed rows of every machine's store, sorted by simulation index """
+    results = [read_results(store_dir, columns) for store_dir in get_store_dirs(sweep_dir)]
+
+    return pd.concat(results).sort_values('sim_index').reset_index(drop=True) if results else pd.DataFrame()
@@ -0,0 +1,330 @@
+#########
+# Parallel parameter sweep that loads the price data once into shared memory for every pool worker
+# usage: python sweep_runner.py --workers 96 --n-sims 100000 --chunk-size 25
+# resumable: python sweep_runner.py --sweep-dir sim_output/sweep_1 --seed 42 --machine-index 0 --n-machines 4
+# adaptive: python sweep_runner.py --qmc sobol --n-sims 100000 --precision .02
+#########
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng
+
+import simulation_functions
+import simulation_parameters
+import batch_simulation
+import streaming_simulation
+from metrics_extraction import calculate_metrics
+from data_cleaning_utils import load_price_data
+from simulation_parameters import QMC_METHODS, SAMPLED_PARAMS, sample_params, sample_params_batch
+from refund_rate_solver import simulate_and_solve_refund_rate
+from batch_simulation import simulate_and_calculate_batch
+from sweep_manifest import (get_simulation_rng, get_shard_rng, load_or_create_manifest, get_pending_shards,
+                            write_shard)
+from results_store import append_results
+from simulation_state import SimulationState
+from instrumentation import (enable, is_enabled, start_run, start_batch_run, collect_records, merge_records,
+                             clear_records, write_reports)
+from adaptive_sampling import (RELATIVE_PRECISION, create_cells, sample_cell, update_cell, is_cell_converged,
+                               get_active_cells, get_round_size, summarize_cells)
+
+PRICE_COLUMNS = ['median_gas_price', 'three_min_median', 'price']
+REFUND_BALANCED_PARAMS = [p for p in SAMPLED_PARAMS if p not in ['refund_rate', 'gas_prediction_ability']]
+
+shared_prices = {}  # set in each worker by attach_shared_prices
+
+
+####
+# shared memory price data
+####
+
+def create_shared_prices(df):
+    """ copies the price columns the simulator uses into one shared memory block, returns the block and its shape """
+    shape = (len(PRICE_COLUMNS), df.shape[0])
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(float).itemsize)
+    prices = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    for i, column in enumerate(PRICE_COLUMNS):
+        prices[i] = np.array(df[column], dtype=float)
+
+    return shm, shape
+
+
+def set_module_rngs(rng=None):
+    """ points every module's rng at one generator, or fresh entropy per module if none is given
+        forked workers inherit the parent's module rngs, so unseeded workers must reset them to avoid repeated runs """
+    for module in (simulation_functions, simulation_parameters, batch_simulation, streaming_simulation):
+        module.rng = rng or default_rng()
+
+
+def attach_shared_prices(shm_name, shape, instrumented=False):
+    """ pool initializer, maps the shared price block into this worker as read-only column views
+        instrumented carries an enable() in the parent over to workers that don't inherit its memory """
+    set_module_rngs()
+    if instrumented:
+        enable()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    prices = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    prices.flags.writeable = False
+
+    shared_prices['shm'] = shm  # keeps the mapping open for the worker's lifetime
+    shared_prices['columns'] = {column: prices[i] for i, column in enumerate(PRICE_COLUMNS)}
+
+
+def get_shared_state():
+    """ the worker's SimulationState over the shared columns, built once so every run reuses its buffers """
+    if 'state' not in shared_prices:
+        shared_prices['state'] = SimulationState(shared_prices['columns'])
+
+    return shared_prices['state']
+
+
+####
+# work units
+####
+
+def simulate_refund_balanced_run(state, params=None):
+    """ run.py's simulation: samples params, unless given, without gas prediction and solves the balanced refund rate
+        returns the params, metrics and P&L state of the run """
+    params = sample_params() if params is None else params
+    params['gas_prediction_ability'] = 0
+    start_run(params)
+    state = simulate_and_solve_refund_rate(state, params)  # sets params['refund_rate'] on a single draw
+
+    return params, calculate_metrics(state, params), state
+
+
+def simulate_refund_balanced_chunk(n_sims):
+    """ runs n_sims of simulate_refund_balanced_run """
+    state = get_shared_state()
+    results = []
+    for i in range(n_sims):
+        params, metrics, _ = simulate_refund_balanced_run(state)
+        results.append({**params, **metrics})
+
+    return pd.DataFrame(results)
+
+
+def simulate_batch(params_batch):
+    """ runs a structured array of param sets through the batched kernel, instrumented as one run """
+    start_batch_run(params_batch)
+
+    return simulate_and_calculate_batch(shared_prices['columns'], params_batch)
+
+
+def simulate_batch_chunk(n_sims):
+    """ samples every param, refund rate included, and runs the chunk through the batched kernel """
+    return simulate_batch(sample_params_batch(n_sims))
+
+
+def simulate_seeded_shard(shard):
+    """ runs one manifest shard, every simulation index gets its own rng derived from the root seed
+        batched shards draw from one rng per shard, so they are reproducible per shard rather than per simulation """
+    seed, batch, shard_index, start, n_sims = shard
+    if batch:
+        set_module_rngs(get_shard_rng(seed, shard_index))
+        result_df = simulate_batch_chunk(n_sims)
+    else:
+        state = get_shared_state()
+        results = []
+        for sim_index in range(start, start + n_sims):
+            set_module_rngs(get_simulation_rng(seed, sim_index))
+            params, metrics, _ = simulate_refund_balanced_run(state)
+            results.append({**params, **metrics})
+        result_df = pd.DataFrame(results)
+
+    result_df.insert(0, 'sim_index', np.arange(start, start + n_sims))
+
+    return shard_index, result_df
+
+
+def simulate_cell_chunk(chunk):
+    """ runs a chunk of one adaptive sweep cell's param sets, returns the cell index with the results """
+    cell_index, params_batch, batch = chunk
+    if batch:
+        return cell_index, simulate_batch(params_batch)
+
+    state = get_shared_state()
+    results = []
+    for row in params_batch:
+        params, metrics, _ = simulate_refund_balanced_run(state, {p: row[p] for p in params_batch.dtype.names})
+        results.append({**params, **metrics})
+
+    return cell_index, pd.DataFrame(results)
+
+
+def rerun_simulation(df, seed, sim_index):
+    """ re-executes one simulation of a non-batched seeded sweep for debugging
+        returns its params, metrics and P&L df """
+    set_module_rngs(get_simulation_rng(seed, sim_index))
+    params, metrics, state = simulate_refund_balanced_run(SimulationState(df))
+
+    return params, metrics, state.to_df()
+
+
+def run_instrumented(work):
+    """ runs a (work unit, args) pair in a pool worker, returns the result with the worker's instrumentation records """
+    work_unit, args = work
+
+    return work_unit(args), collect_records()
+
+
+def get_chunk_sizes(n_sims, chunk_size):
+    """ splits n_sims into work units of chunk_size, the last one holds the remainder """
+    return [min(chunk_size, n_sims - i) for i in range(0, n_sims, chunk_size)]
+
+
+def run_sweep(df, n_sims, chunk_size=25, n_workers=None, output_dir='sim_output', batch=False, store_dir=None):
+    """ hands chunks of simulations to a process pool as workers free up and writes each finished chunk to csv,
+        or appends it to the results store in store_dir
+        workers map the prices from shared memory, so memory stays flat as n_workers grows """
+    n_workers = n_workers or mp.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+    shm, shape = create_shared_prices(df)
+    work_unit = simulate_batch_chunk if batch else simulate_refund_balanced_chunk
+    clear_records()
+
+    try:
+        with mp.Pool(n_workers, initializer=attach_shared_prices, initargs=(shm.name, shape, is_enabled())) as pool:
+            work = [(work_unit, n) for n in get_chunk_sizes(n_sims, chunk_size)]
+            chunks = pool.imap_unordered(run_instrumented, work)
+            for i, (result_df, worker_records) in enumerate(chunks):
+                merge_records(worker_records)
+                if store_dir:
+                    append_results(store_dir, result_df)
+                else:
+                    result_df.to_csv(os.path.join(output_dir, '{}_{}.csv'.format(int(time.time()), i)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if is_enabled():
+        write_reports(output_dir)
+
+
+def run_manifest_sweep(df, sweep_dir, n_sims, chunk_size=25, n_workers=None, batch=False, seed=None,
+                       machine_index=0, n_machines=1):
+    """ resumable, reproducible sweep, every chunk is a manifest shard committed to this machine's store in sweep_dir
+        a restart skips finished shards and machines sharing sweep_dir split the shards by machine_index """
+    manifest = load_or_create_manifest(sweep_dir, n_sims, chunk_size, batch, seed)
+    shards = [(manifest['seed'], manifest['batch'], *shard) for shard in
+              get_pending_shards(sweep_dir, manifest, machine_index, n_machines)]
+    shm, shape = create_shared_prices(df)
+    clear_records()
+
+    try:
+        with mp.Pool(n_workers or mp.cpu_count(), initializer=attach_shared_prices,
+                     initargs=(shm.name, shape, is_enabled())) as pool:
+            work = [(simulate_seeded_shard, shard) for shard in shards]
+            for (shard_index, result_df), worker_records in pool.imap_unordered(run_instrumented, work):
+                merge_records(worker_records)
+                write_shard(sweep_dir, shard_index, result_df, machine_index)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if is_enabled():
+        write_reports(sweep_dir)
+
+
+def run_adaptive_sweep(df, n_sims, chunk_size=25, n_workers=None, output_dir='sim_output', batch=False,
+                       store_dir=None, method='sobol', round_size=64, relative_precision=RELATIVE_PRECISION, seed=None):
+    """ stratified quasi-monte carlo sweep, every upfront_fee x upfront_hours cell runs rounds of round_size points
+        until the CIs of its key metrics reach relative_precision or it has used its share of n_sims
+        without batch the refund rate is solved and gas prediction is off, so the cells don't sample either
+        results are written like run_sweep's, the per-cell summary goes to convergence_summary.csv and is returned """
+    os.makedirs(output_dir, exist_ok=True)
+    cells = create_cells(method, seed, SAMPLED_PARAMS if batch else REFUND_BALANCED_PARAMS)
+    max_sims_per_cell = n_sims // len(cells)
+    if max_sims_per_cell < 1:
+        raise ValueError('{} simulations are fewer than the {} cells'.format(n_sims, len(cells)))
+    shm, shape = create_shared_prices(df)
+    clear_records()
+
+    try:
+        with mp.Pool(n_workers or mp.cpu_count(), initializer=attach_shared_prices,
+                     initargs=(shm.name, shape, is_enabled())) as pool:
+            round_index = 0
+            while get_active_cells(cells, max_sims_per_cell):
+                chunks = []
+                for cell_index in get_active_cells(cells, max_sims_per_cell):
+                    n_points = get_round_size(cells[cell_index], round_size, max_sims_per_cell)
+                    params_batch = sample_cell(cells[cell_index], n_points)
+                    chunks += [(simulate_cell_chunk, (cell_index, params_batch[i:i + chunk_size], batch)) for i in
+                               range(0, n_points, chunk_size)]
+
+                results = pool.imap_unordered(run_instrumented, chunks)
+                for i, ((cell_index, result_df), worker_records) in enumerate(results):
+                    merge_records(worker_records)
+                    update_cell(cells[cell_index], result_df)
+                    if store_dir:
+                        append_results(store_dir, result_df)
+                    else:
+                        path = os.path.join(output_dir, '{}_{}_{}.csv'.format(int(time.time()), round_index, i))
+                        result_df.to_csv(path)
+
+                for cell in cells:  # only checked on whole rounds, which keep the sobol points balanced
+                    cell['converged'] = is_cell_converged(cell, relative_precision)
+                round_index += 1
+    finally:
+        shm.close()
+        shm.unlink()
+
+    summary = summarize_cells(cells)
+    summary.to_csv(os.path.join(output_dir, 'convergence_summary.csv'), index=False)
+    if is_enabled():
+        write_reports(output_dir)
+
+    return summary
+
+
+def parse_args(args=None):
+    """ parses the sweep command line """
+    parser = argparse.ArgumentParser(description='Runs a parallel Superfluid liquidations parameter sweep.')
+    parser.add_argument('--input', default='input_data.csv', help='price data csv')
+    parser.add_argument('--output-dir', default='sim_output', help='directory for result csvs')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='n pool workers')
+    parser.add_argument('--n-sims', type=int, default=10000, help='total n simulations')
+    parser.add_argument('--chunk-size', type=int, default=25, help='n simulations per work unit')
+    parser.add_argument('--batch', action='store_true',
+                        help='sample refund rates and use the batched kernel instead of solving each refund rate')
+    parser.add_argument('--store', help='append results to this results store instead of writing csvs')
+    parser.add_argument('--sweep-dir', help='resumable sweep directory, its manifest overrides the other options')
+    parser.add_argument('--seed', type=int, help='root seed of a new resumable sweep, fresh entropy if not set')
+    parser.add_argument('--machine-index', type=int, default=0, help='this machine\'s index in a shared sweep dir')
+    parser.add_argument('--n-machines', type=int, default=1, help='n machines sharing the sweep dir')
+    parser.add_argument('--qmc', choices=QMC_METHODS,
+                        help='stratified quasi-monte carlo sweep that stops each fee x hours cell once converged, '
+                             '--n-sims is then the budget over all cells')
+    parser.add_argument('--round-size', type=int, default=64,
+                        help='n points per cell between convergence checks, a power of 2 for sobol')
+    parser.add_argument('--precision', type=float, default=RELATIVE_PRECISION,
+                        help='target CI half width relative to the mean')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record per-stage timings and counters, same as setting SIM_INSTRUMENT=1, the reports '
+                             'are written next to the results')
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.instrument:
+        enable()
+    df = load_price_data(args.input)
+    if args.qmc:
+        run_adaptive_sweep(df, args.n_sims, args.chunk_size, args.workers, args.output_dir, args.batch, args.store,
+                           args.qmc, args.round_size, args.precision, args.seed)
+    elif args.sweep_dir:
+        run_manifest_sweep(df, args.sweep_dir, args.n_sims, args.chunk_size, args.workers, args.batch, args.seed,
+                           args.machine_index, args.n_machines)
+    else:
+        run_sweep(df, args.n_sims, args.chunk_size, args.workers, args.output_dir, args.batch, args.store)
+
+
+if __name__ == '__main__':
+    main()
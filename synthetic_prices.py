@@ -0,0 +1,87 @@
+####
+# synthetic minute-level gas and ETH price data with the columns of input_data.csv, for benchmarks and tests without
+# the real data
+# log gas prices mean revert around a daily and weekly cycle with short-lived spikes, ETH follows a geometric random
+# walk whose volatility switches between a calm and a volatile regime
+####
+
+import numpy as np
+import pandas as pd
+from numpy.random import default_rng
+from scipy.signal import lfilter
+
+MINUTES_PER_DAY = 60 * 24
+DURATIONS = {  # n minutes of the standard benchmark lengths
+    '1w': 7 * MINUTES_PER_DAY,
+    '1m': 30 * MINUTES_PER_DAY,
+    '6m': 182 * MINUTES_PER_DAY,
+    '1y': 365 * MINUTES_PER_DAY,
+    '5y': 5 * 365 * MINUTES_PER_DAY,
+}
+
+GAS_MEDIAN_GWEI = 60
+GAS_REVERSION_PER_MINUTE = .002  # pull of log gas back to its cycle, about an 8 hour half life
+GAS_VOLATILITY = .03
+GAS_DAILY_AMPLITUDE = .25  # in log gas, busiest in the US afternoon
+GAS_WEEKLY_AMPLITUDE = .1
+GAS_SPIKES_PER_DAY = 2
+GAS_SPIKE_SIZE = 1.  # mean jump in log gas
+GAS_MAX_SPIKE = 3.  # overlapping spikes top out at 20x the usual gas price
+GAS_SPIKE_REVERSION_PER_MINUTE = .02  # spikes fade within about half an hour
+GAS_NOISE = .1  # minute to minute noise of the median around the mean reverting level
+
+ETH_START_PRICE = 2000
+ETH_VOLATILITIES = (.0006, .0015)  # per minute log return std of the calm and volatile regimes
+ETH_REGIME_MINUTES = 14 * MINUTES_PER_DAY  # mean regime length
+
+
+def simulate_mean_reversion(shocks, reversion):
+    """ x[t] = (1 - reversion) * x[t - 1] + shocks[t], as a linear filter so it stays vectorized """
+    return lfilter([1], [1, reversion - 1], shocks)
+
+
+def rolling_median_3(values):
+    """ trailing 3 minute median, the first two minutes use what is available like pandas' min_periods=1 """
+    medians = values.copy()
+    medians[1] = (values[0] + values[1]) / 2
+    a, b, c = values[:-2], values[1:-1], values[2:]
+    medians[2:] = np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+    return medians
+
+
+def generate_gas_prices(n_minutes, rng):
+    minutes = np.arange(n_minutes)
+    cycle = (GAS_DAILY_AMPLITUDE * np.sin(2 * np.pi * (minutes / MINUTES_PER_DAY - .375)) +
+             GAS_WEEKLY_AMPLITUDE * np.sin(2 * np.pi * minutes / (7 * MINUTES_PER_DAY)))
+
+    shocks = rng.normal(0, GAS_VOLATILITY, n_minutes)
+    spikes = np.zeros(n_minutes)
+    spike_mask = rng.uniform(0, 1, n_minutes) < GAS_SPIKES_PER_DAY / MINUTES_PER_DAY
+    spikes[spike_mask] = rng.exponential(GAS_SPIKE_SIZE, np.sum(spike_mask))
+    log_gas = (np.log(GAS_MEDIAN_GWEI) + cycle + simulate_mean_reversion(shocks, GAS_REVERSION_PER_MINUTE) +
+               np.minimum(simulate_mean_reversion(spikes, GAS_SPIKE_REVERSION_PER_MINUTE), GAS_MAX_SPIKE) +
+               rng.normal(0, GAS_NOISE, n_minutes))
+
+    return np.exp(log_gas)
+
+
+def generate_eth_prices(n_minutes, rng):
+    regime_starts = np.cumsum(rng.exponential(ETH_REGIME_MINUTES, n_minutes // ETH_REGIME_MINUTES + 10))
+    regimes = np.searchsorted(regime_starts, np.arange(n_minutes)) % 2
+    log_returns = rng.normal(0, 1, n_minutes) * np.array(ETH_VOLATILITIES)[regimes]
+
+    return ETH_START_PRICE * np.exp(np.cumsum(log_returns))
+
+
+def generate_price_data(n_minutes, seed=None, start_time='2021-03-01'):
+    """ returns a df with time, median_gas_price, three_min_median and price columns for n_minutes minutes
+        n_minutes can be a key of DURATIONS such as '1w' or '5y' """
+    n_minutes = DURATIONS.get(n_minutes, n_minutes)
+    rng = default_rng(seed)
+    median_gas_price = generate_gas_prices(n_minutes, rng)
+
+    return pd.DataFrame({'time': pd.date_range(start_time, periods=n_minutes, freq='min'),
+                         'median_gas_price': median_gas_price,
+                         'three_min_median': rolling_median_3(median_gas_price),
+                         'price': generate_eth_prices(n_minutes, rng)})
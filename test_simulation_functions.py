@@ -0,0 +1,95 @@
+####
+# gas prediction P&L against the dense window matrix implementation it replaced, on a fixed small input with at most
+# one liquidation per minute, where per-minute size sums equal the average sizes the old implementation used
+####
+
+import numpy as np
+import pytest
+from numpy.random import default_rng
+
+from simulation_functions import (LIQUIDATION_GAS, gwei_to_eth, stream_rate_to_margin, month_to_minute,
+                                  find_best_executions, calculate_pl)
+from simulation_state import SimulationState
+from synthetic_prices import generate_price_data
+
+N_ROWS = 3000
+PARAMS = {'upfront_fee': .025, 'upfront_hours': 4, 'refund_rate': .4}
+
+
+def calculate_liquidator_pl_with_prediction_dense(df, params):
+    """ the pre-tiling implementation, one (n liquidations x window) matrix of every possible execution """
+    n = int(params['gas_prediction_ability'] * 60)
+    gas_prices = np.array(df['three_min_median'])
+    output_n_rows = gas_prices.shape[0] - n + 3
+
+    l_mask_subset = np.asarray(np.array(df['n_liquidated']) > 0)[:output_n_rows]
+    gas_indices = np.arange(n - 2)[None, :] + np.arange(output_n_rows)[l_mask_subset][:, None]
+    n_rows = gas_indices.shape[0]
+
+    sizes = np.array(df['avg_liquidation_size'])[:output_n_rows][l_mask_subset]
+    posted_margin = stream_rate_to_margin(sizes, params['upfront_hours'])
+    stream_per_minute = month_to_minute(sizes)
+    eth_price = np.array(df['price'])[:output_n_rows][l_mask_subset]
+
+    remaining_margin = posted_margin[:, None] - np.arange(n - 2)[None, :] * stream_per_minute[:, None]
+    tx_costs = LIQUIDATION_GAS * gwei_to_eth(gas_prices[gas_indices]) * eth_price[:n_rows, None] * (
+            1 - params['refund_rate'])
+    liquidator_profits = remaining_margin - tx_costs
+    best_execution_indices = np.argmax(liquidator_profits, axis=1)
+
+    gas_prices_paid, liquidator_pl = np.zeros(output_n_rows), np.zeros(output_n_rows)
+    gas_prices_paid[l_mask_subset] = gas_prices[gas_indices][np.arange(n_rows), best_execution_indices]
+    liquidator_pl[l_mask_subset] = liquidator_profits[np.arange(n_rows), best_execution_indices]
+    gas_refunded_eth = (LIQUIDATION_GAS * np.array(df['n_liquidated'])[:output_n_rows] * gwei_to_eth(gas_prices_paid) *
+                        params['refund_rate'])
+
+    return gas_prices_paid, liquidator_pl, np.array(df['n_opened'])[:output_n_rows] * params['upfront_fee'] - \
+        gas_refunded_eth
+
+
+@pytest.fixture
+def pl_df():
+    rng = default_rng(0)
+    df = generate_price_data(N_ROWS, 0)
+    df['n_liquidated'] = (rng.uniform(size=N_ROWS) < .05).astype(float)
+    df['avg_liquidation_size'] = df['n_liquidated'] * rng.uniform(100, 5000, N_ROWS)
+    df['liquidation_size_sum'] = df['avg_liquidation_size']
+    df['n_opened'] = rng.poisson(.5, N_ROWS).astype(float)
+
+    return df
+
+
+@pytest.mark.parametrize('gas_prediction_ability', [.25, 1, 6])
+def test_prediction_pl_matches_dense(pl_df, gas_prediction_ability):
+    params = {**PARAMS, 'gas_prediction_ability': gas_prediction_ability}
+    gas_prices_paid, liquidator_pl, gas_tank_eth_pl = calculate_liquidator_pl_with_prediction_dense(pl_df, params)
+
+    state = calculate_pl(SimulationState(pl_df), params)
+    assert state.n_rows == gas_prices_paid.shape[0]
+    np.testing.assert_array_equal(state['gas_price_paid'], gas_prices_paid)
+    np.testing.assert_allclose(state['liquidator_pl'], liquidator_pl, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(state['gas_tank_eth_pl'], gas_tank_eth_pl, rtol=1e-12, atol=1e-15)
+
+
+def test_no_prediction_pl_matches_baseline(pl_df):
+    params = {**PARAMS, 'gas_prediction_ability': 0}
+    liquidator_pl = (pl_df['n_liquidated'] * stream_rate_to_margin(pl_df['avg_liquidation_size'],
+                                                                   params['upfront_hours']) -
+                     LIQUIDATION_GAS * pl_df['n_liquidated'] * gwei_to_eth(pl_df['median_gas_price']) *
+                     pl_df['price'] * (1 - params['refund_rate']))
+
+    state = calculate_pl(SimulationState(pl_df), params)
+    np.testing.assert_allclose(state['liquidator_pl'], liquidator_pl, rtol=1e-12, atol=1e-12)
+
+
+def test_execution_tiles_match_one_tile(pl_df):
+    rows = np.flatnonzero(pl_df['n_liquidated'][:N_ROWS - 200] > 0)
+    sizes = np.array(pl_df['avg_liquidation_size'])[rows]
+    args = (np.array(pl_df['three_min_median']), rows, stream_rate_to_margin(sizes, 4), month_to_minute(sizes),
+            np.array(pl_df['price'])[rows], 178, .4)
+
+    one_tile = find_best_executions(*args, chunk_size=rows.shape[0] * 178, return_steps=True)
+    for chunk_size in (1, 64, 1000):
+        tiled = find_best_executions(*args, chunk_size=chunk_size, return_steps=True)
+        for expected, result in zip(one_tile, tiled):
+            np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,61 @@
+####
+# chunked runs against one chunk over the whole history, on a fixed set of streams so the draws don't depend on the
+# chunk layout
+####
+
+import numpy as np
+import pytest
+from numpy.random import default_rng
+
+import streaming_simulation
+from streaming_simulation import get_prediction_overlap, simulate_and_calculate_metrics_chunked
+from synthetic_prices import generate_price_data
+
+N_ROWS = 20000
+N_STREAMS = 400
+PARAMS = {
+    'upfront_fee': .025,
+    'upfront_hours': 4,
+    'monthly_opened_streams': 1000,
+    'average_stream_lifetime': 30,
+    'percent_accidently_liquidated_per_month': 20,
+    'average_stream_size': 1000,
+    'refund_rate': .5,
+    'min_self_liquidation_savings': 10,
+    'gas_prediction_ability': 2,
+    'lowest_stream_cost_ratio': 1.5,
+    'distribution_inverse_skewness': 2,
+}
+
+
+@pytest.fixture
+def fixed_streams(monkeypatch):
+    """ replaces stream sampling with one seeded set of streams, each chunk opens the ones starting in its body """
+    rng = default_rng(0)
+    times = np.sort(rng.integers(0, N_ROWS, N_STREAMS))
+    streams = {'times': times, 'sizes': rng.uniform(100, 5000, N_STREAMS),
+               'end_times': times + rng.exponential(3000, N_STREAMS),
+               'liquidation_mask': rng.uniform(size=N_STREAMS) < .5}
+
+    def open_streams_in_chunk(open_streams, start, chunk, n_body_rows, params, steps_per_minute=1):
+        opened = (streams['times'] >= start) & (streams['times'] < start + n_body_rows)
+        for key in open_streams:
+            open_streams[key] = np.concatenate([open_streams[key], streams[key][opened]])
+
+        return streams['times'][opened] - start, streams['sizes'][opened]
+
+    monkeypatch.setattr(streaming_simulation, 'open_streams_in_chunk', open_streams_in_chunk)
+
+
+@pytest.mark.parametrize('gas_prediction_ability', [0, 2])
+def test_chunked_matches_one_chunk(fixed_streams, gas_prediction_ability):
+    params = {**PARAMS, 'gas_prediction_ability': gas_prediction_ability}
+    overlap = get_prediction_overlap(params)
+    prices = generate_price_data(N_ROWS, 0)
+    expected = simulate_and_calculate_metrics_chunked(prices, params, chunk_size=N_ROWS)
+
+    # the last two leave a final chunk no longer than the prediction overlap
+    for chunk_size in (4096, 5000, N_ROWS - overlap, N_ROWS - overlap // 2):
+        metrics = simulate_and_calculate_metrics_chunked(prices, params, chunk_size=chunk_size)
+        for key, value in expected.items():
+            assert metrics[key] == pytest.approx(value, rel=1e-9, nan_ok=True), (chunk_size, key)